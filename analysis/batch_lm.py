@@ -0,0 +1,182 @@
+import numpy as np
+
+
+# status of every trace, the same codes as fit_batch.STATUS
+LM_OK = 0
+LM_NOT_CONVERGED = 1
+LM_ERROR = 2
+LM_NO_ERRORS = 3
+LM_NAN_DATA = 4
+
+
+def batch_lm(func, jac, x, Y, P0, max_iter=200, xtol=1.49012e-8, ftol=1.49012e-8,
+             lam=1e-3, chunk=256):
+    '''
+    Levenberg-Marquardt fit of K traces of the same model at once.
+
+    All traces of a chunk are stepped together with stacked NumPy
+    arrays: one model and one Jacobian call per iteration for the
+    whole chunk, batched normal equations J^T J solved with
+    np.linalg.solve, and a damping factor and convergence flag
+    per trace. Converged traces drop out of the chunk.
+
+    Parameters
+    ----------
+    func : model func(x, *params) -> (len(x),). Called with (k, 1)
+        parameter columns, it must broadcast to (k, len(x)), like
+        the models of Fitter and FitterComplex.model_func.
+    jac : Jacobian jac(x, *params) -> (k, len(x), n_params) for
+        (k, 1) parameter columns, e.g. Fitter.model_jac.
+    x : (M,) independent variable
+    Y : (K, M) real data
+    P0 : (K, n_params) starting values
+    max_iter : iterations per chunk
+    xtol : relative change of every parameter below which a trace
+        has converged
+    ftol : relative decrease of the sum of squares below which a
+        trace has converged
+    lam : starting damping factor
+    chunk : traces stepped together, limits the (chunk, M, n_params)
+        Jacobian in memory
+
+    Returns
+    -------
+    popt, perr : (K, n_params), perr as curve_fit (absolute_sigma=False)
+    status : (K,) int8, LM_OK (0) for converged traces, LM_NAN_DATA
+        for rows of Y with NaN, LM_ERROR for non-finite starting
+        values (e.g. a failed initial guess, see start_values)
+    nfev : (K,) model evaluations of every trace
+    '''
+    Y = np.asarray(Y, dtype=float)
+    P0 = np.asarray(P0, dtype=float)
+    K, npar = P0.shape
+    popt = np.full((K, npar), np.nan)
+    perr = np.full((K, npar), np.nan)
+    status = np.full(K, LM_ERROR, dtype=np.int8)
+    nfev = np.zeros(K, dtype=int)
+
+    finite_data = np.all(np.isfinite(Y), axis=1)
+    status[~finite_data] = LM_NAN_DATA
+    rows = np.flatnonzero(finite_data & np.all(np.isfinite(P0), axis=1))
+    for start in range(0, len(rows), chunk):
+        idx = rows[start:start+chunk]
+        p, e, s, n = _lm_chunk(func, jac, x, Y[idx], P0[idx], max_iter, xtol, ftol, lam)
+        popt[idx], perr[idx], status[idx], nfev[idx] = p, e, s, n
+    return popt, perr, status, nfev
+
+
+def start_values(initial_guess, x, Y, npar, guess=None):
+    '''
+    (K, npar) starting values for batch_lm: guess broadcast to all
+    rows, or initial_guess(x, y) of every row.
+
+    Returns (P0, messages). Rows with finite data whose guess fails
+    or is not finite are NaN in P0 (batch_lm reports them as
+    LM_ERROR) and messages holds the reason, '' for all other rows.
+    '''
+    messages = ['']*len(Y)
+    if guess is not None:
+        P0 = np.broadcast_to(np.asarray(guess, dtype=float), (len(Y), npar)).copy()
+    else:
+        P0 = np.full((len(Y), npar), np.nan)
+        for i, y in enumerate(Y):
+            if not np.all(np.isfinite(y)):
+                continue
+            try:
+                P0[i] = initial_guess(x, y)
+            except Exception as e:
+                messages[i] = f'initial_guess failed: {type(e).__name__}: {e}'
+    for i in np.flatnonzero(~np.all(np.isfinite(P0), axis=1)):
+        if not messages[i] and np.all(np.isfinite(Y[i])):
+            messages[i] = 'starting values are not finite'
+    return P0, messages
+
+
+def _call(func, x, P):
+    return func(x, *(P[:, i:i+1] for i in range(P.shape[1])))
+
+
+def _normal_eq(J, r):
+    # J^T J and J^T r of every trace, batched matmul is several
+    # times faster than einsum here
+    Jt = J.transpose(0, 2, 1)
+    return Jt @ J, (Jt @ r[..., None])[..., 0]
+
+
+def _lm_chunk(func, jac, x, Y, P, max_iter, xtol, ftol, lam):
+    K, npar = P.shape
+    M = Y.shape[1]
+    P = P.copy()
+    r = Y - _call(func, x, P)
+    cost = np.einsum('km,km->k', r, r)
+    A, g = _normal_eq(np.broadcast_to(_call(jac, x, P), (K, M, npar)), r)
+    # scaling by the column norms of J, never decreasing as in MINPACK
+    D = np.sqrt(np.diagonal(A, axis1=1, axis2=2)).copy()
+    D[D == 0] = 1.
+    lam = np.full(K, lam)
+    nu = np.full(K, 2.)
+    nfev = np.ones(K, dtype=int)
+    status = np.full(K, LM_NOT_CONVERGED, dtype=np.int8)
+    active = np.isfinite(cost)
+    status[~active] = LM_ERROR
+    eye = np.eye(npar)
+
+    for _ in range(max_iter):
+        act = np.flatnonzero(active)
+        if not len(act):
+            break
+        d = D[act]
+        As = A[act] / (d[:, :, None]*d[:, None, :])
+        gs = g[act] / d
+        try:
+            hs = np.linalg.solve(As + lam[act, None, None]*eye, gs[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            hs = np.stack([np.linalg.lstsq(a + l*eye, b, rcond=None)[0]
+                           for a, b, l in zip(As, gs, lam[act])])
+        step = hs / d
+
+        trial = P[act] + step
+        r_trial = Y[act] - _call(func, x, trial)
+        cost_trial = np.einsum('km,km->k', r_trial, r_trial)
+        nfev[act] += 1
+
+        # gain ratio of the actual to the predicted decrease (Nielsen)
+        pred = np.einsum('kp,kp->k', hs, lam[act, None]*hs + gs)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rho = (cost[act] - cost_trial) / pred
+        better = np.isfinite(cost_trial) & (rho > 0)
+        small_step = np.all(np.abs(step) <= xtol*(np.abs(P[act]) + xtol), axis=1)
+        small_gain = better & (cost[act] - cost_trial <= ftol*cost[act])
+
+        acc = act[better]
+        P[acc] = trial[better]
+        cost[acc] = cost_trial[better]
+        lam[acc] *= np.maximum(1/3, 1 - (2*rho[better] - 1)**3)
+        nu[acc] = 2.
+        rej = act[~better]
+        lam[rej] *= nu[rej]
+        nu[rej] *= 2
+        if len(acc):
+            J = np.broadcast_to(_call(jac, x, P[acc]), (len(acc), M, npar))
+            A[acc], g[acc] = _normal_eq(J, r_trial[better])
+            D[acc] = np.maximum(D[acc], np.sqrt(np.diagonal(A[acc], axis1=1, axis2=2)))
+
+        done = act[small_step | small_gain]
+        status[done] = LM_OK
+        active[done] = False
+        stuck = act[lam[act] > 1e16]
+        active[stuck] = False
+
+    # covariance as curve_fit: inv(J^T J) * chi2/dof
+    ok = status != LM_ERROR
+    perr = np.full((K, npar), np.nan)
+    if np.any(ok):
+        d = np.sqrt(np.diagonal(A[ok], axis1=1, axis2=2))
+        d = np.where(d > 0, d, 1.)
+        cov = np.linalg.pinv(A[ok] / (d[:, :, None]*d[:, None, :])) / (d[:, :, None]*d[:, None, :])
+        cov *= (cost[ok] / max(M - npar, 1))[:, None, None]
+        perr[ok] = np.sqrt(np.abs(np.diagonal(cov, axis1=1, axis2=2)))
+        singular = np.linalg.matrix_rank(A[ok] / (d[:, :, None]*d[:, None, :])) < npar
+        status[np.flatnonzero(ok)[singular & (status[ok] == LM_OK)]] = LM_NO_ERRORS
+    status[~np.all(np.isfinite(P), axis=1)] = LM_ERROR
+    return P, perr, status, nfev
@@ -0,0 +1,188 @@
+import os
+import re
+import sqlite3
+import hashlib
+from datetime import datetime
+
+
+class Catalog:
+    '''
+    SQLite index of the measurement folders made by begin_save
+    (D:\\Data\\YYYYMMDD_device\\HHMMSS_name) and mstart
+    (D:\\data\\YYYYMMDD\\HHMMSS_name).
+
+    For every folder it stores the date/time, device id, experiment
+    name, the sweep axes of the .meta.txt, number of .dat columns,
+    a hash of the copied script and the size of the data files.
+    scan() only re-reads folders that are new or changed since
+    the last scan.
+
+    cat = Catalog('D:\\Data\\catalog.db')
+    cat.scan('D:\\Data')
+    cat.query(device='chipA', exp_name='power', since='20250101')
+    '''
+    _axes = ('inner', 'outer', 'outmost')
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.con = sqlite3.connect(db_file)
+        axis_cols = ''.join(f'{a}_name TEXT, {a}_npts INTEGER, {a}_start REAL, {a}_stop REAL, '
+                            for a in self._axes)
+        self.con.execute('CREATE TABLE IF NOT EXISTS runs ('
+                         'path TEXT PRIMARY KEY, date TEXT, time TEXT, '
+                         'device TEXT, exp_name TEXT, '
+                         + axis_cols +
+                         'num_columns INTEGER, num_files INTEGER, data_bytes INTEGER, '
+                         'script_hash TEXT, mtime REAL)')
+        self.con.execute('CREATE INDEX IF NOT EXISTS runs_date ON runs (date)')
+        self.con.execute('CREATE INDEX IF NOT EXISTS runs_device ON runs (device)')
+        self.con.execute('CREATE INDEX IF NOT EXISTS runs_exp ON runs (exp_name)')
+        self.con.commit()
+
+    def scan(self, root):
+        '''
+        Index all measurement folders below root.
+        Returns the number of folders added or updated.
+        '''
+        known = dict(self.con.execute('SELECT path, mtime FROM runs'))
+        updated = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            if not any(f.endswith('.dat') or f.endswith('.meta.txt') for f in filenames):
+                continue
+            mtime = max(os.path.getmtime(os.path.join(dirpath, f)) for f in filenames + ['.'])
+            if known.get(dirpath) == mtime:
+                continue
+            row = self._folder_info(dirpath, filenames)
+            row['mtime'] = mtime
+            cols = ', '.join(row)
+            marks = ', '.join('?' for _ in row)
+            self.con.execute(f'INSERT OR REPLACE INTO runs ({cols}) VALUES ({marks})',
+                             tuple(row.values()))
+            updated += 1
+        self.con.commit()
+        return updated
+
+    def _folder_info(self, dirpath, filenames):
+        row = {'path': dirpath}
+        row.update(_parse_folder_name(dirpath))
+
+        meta_files = sorted(f for f in filenames if f.endswith('.meta.txt'))
+        if meta_files:
+            axes = _parse_meta(os.path.join(dirpath, meta_files[0]))
+            for axis, values in zip(self._axes, axes):
+                row[f'{axis}_npts'], row[f'{axis}_start'], row[f'{axis}_stop'], row[f'{axis}_name'] = values
+
+        dat_files = sorted(f for f in filenames if f.endswith('.dat'))
+        row['num_files'] = len(dat_files)
+        row['data_bytes'] = sum(os.path.getsize(os.path.join(dirpath, f)) for f in dat_files)
+        row['num_columns'] = _count_columns(os.path.join(dirpath, dat_files[0])) if dat_files else None
+
+        scripts = sorted(f for f in filenames if f.endswith('.py'))
+        if scripts:
+            with open(os.path.join(dirpath, scripts[0]), 'rb') as fl:
+                row['script_hash'] = hashlib.sha1(fl.read()).hexdigest()
+        return row
+
+    def query(self, device=None, exp_name=None, since=None, until=None,
+              axis=None, script_hash=None):
+        '''
+        Paths of the indexed folders matching all given filters,
+        oldest first.
+
+        device, exp_name, axis : SQL LIKE patterns without the
+            surrounding %, e.g. exp_name='power' matches power_sweep.
+            axis matches the name of any of the sweep axes.
+        since, until : 'YYYYMMDD' strings or datetime, inclusive.
+        '''
+        where, args = [], []
+        if device is not None:
+            where.append('device LIKE ?')
+            args.append(f'%{device}%')
+        if exp_name is not None:
+            where.append('exp_name LIKE ?')
+            args.append(f'%{exp_name}%')
+        if since is not None:
+            where.append('date >= ?')
+            args.append(_date_string(since))
+        if until is not None:
+            where.append('date <= ?')
+            args.append(_date_string(until))
+        if axis is not None:
+            where.append('(' + ' OR '.join(f'{a}_name LIKE ?' for a in self._axes) + ')')
+            args.extend([f'%{axis}%']*len(self._axes))
+        if script_hash is not None:
+            where.append('script_hash = ?')
+            args.append(script_hash)
+
+        sql = 'SELECT path FROM runs'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY date, time'
+        return [path for (path,) in self.con.execute(sql, args)]
+
+    def info(self, path):
+        '''
+        All indexed fields of one folder as a dict.
+        '''
+        cur = self.con.execute('SELECT * FROM runs WHERE path = ?', (path,))
+        row = cur.fetchone()
+        if row is None:
+            raise KeyError(f"'{path}' is not in the catalog.")
+        return dict(zip([c[0] for c in cur.description], row))
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _parse_folder_name(dirpath):
+    '''
+    date, time, device and experiment name from
+    .../YYYYMMDD_device/HHMMSS_name or .../YYYYMMDD/HHMMSS_name
+    '''
+    info = {'date': None, 'time': None, 'device': None, 'exp_name': None}
+    name = os.path.basename(os.path.normpath(dirpath))
+    parent = os.path.basename(os.path.dirname(os.path.normpath(dirpath)))
+    m = re.match(r'(\d{6})_?(.*)', name)
+    if m:
+        info['time'], info['exp_name'] = m.group(1), m.group(2)
+    m = re.match(r'(\d{8})_?(.*)', parent)
+    if m:
+        info['date'] = m.group(1)
+        info['device'] = m.group(2) or None
+    return info
+
+
+def _parse_meta(filepath):
+    # [npts, first, last, name] for inner, outer and outmost
+    with open(filepath, 'r') as file:
+        lines = [line.strip() for line in file if not line.startswith('#') and line.strip()]
+    axes = []
+    for i in range(3):
+        if len(lines) < 4*(i+1):
+            break
+        npts, start, stop, name = lines[4*i:4*i+4]
+        try:
+            axes.append((int(float(npts)), float(start), float(stop), name))
+        except ValueError:
+            break
+    return axes
+
+
+def _count_columns(filepath):
+    with open(filepath, 'r') as file:
+        for line in file:
+            if not line.startswith('#') and line.strip():
+                return len(line.split())
+    return 0
+
+
+def _date_string(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y%m%d')
+    return str(value)
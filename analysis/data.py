@@ -1,9 +1,84 @@
 import os
+import io
+import json
+import hashlib
+import traceback
+from collections.abc import Mapping
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import xarray as xr
 
+
+def _axis_values(filepath):
+    '''
+    {dim: setpoints} from the '#values inner|outer|outmost ..' lines
+    that meta_quick adds to the .meta.txt for non-uniform loops
+    (log, dB, center, array spacing, adaptive_loop). Setpoints are
+    in measurement order.
+    '''
+    values = {}
+    with open(filepath, 'r') as file:
+        for line in file:
+            if line.startswith('#values '):
+                parts = line.split()
+                values[parts[1]] = np.array(parts[2:], dtype=float)
+    return values
+
+
+def read_sidecar(filepath):
+    '''
+    Memory-map the binary sidecar written by loop_write /
+    begin_save(..., sidecar=True).
+
+    Parameters
+    ----------
+    filepath : <name>.bin, or the <name>.dat next to it.
+
+    Returns
+    -------
+    (data, header): data is a read-only (rows, columns) array,
+    header the dict of <name>.bin.json (dtype, columns, names and
+    the sweep axes [npts, first, last, name]). An incomplete last
+    row of a sweep that is still writing is left out.
+    '''
+    if filepath.endswith('.dat'):
+        filepath = filepath[:-4]+'.bin'
+    with open(filepath+'.json', 'r') as fl:
+        header = json.load(fl)
+    dtype = np.dtype(header['dtype'])
+    columns = header['columns']
+    rows = os.path.getsize(filepath) // (columns*dtype.itemsize)
+    if rows == 0:
+        return np.zeros((0, columns), dtype=dtype), header
+    data = np.memmap(filepath, dtype=dtype, mode='r', shape=(rows, columns))
+    return data, header
+
+
 class Data2D:
-    def __init__(self, directory):
+    '''
+    Reader for a directory with one .dat and one .meta.txt file.
+
+    The .dat file is parsed only once, on the first Z() call, into
+    a columnar array (one contiguous row per .dat column). With
+    cache=True the array is also saved next to the data as
+    <name>.cache.npy, keyed on the size and mtime of the .dat
+    (<name>.cache.json), and memory-mapped when the directory
+    is opened again.
+
+    With partial=True a sweep that is still running (or was
+    aborted) can be opened: Z() returns the outer rows written so
+    far, the last one NaN-padded if incomplete, and Y is cut to
+    the same length. refresh() reads only the new rows.
+
+    If the binary sidecar <name>.bin (see read_sidecar) is present,
+    the columns are memory-mapped from it instead, without any
+    text parsing. sidecar=False always reads the .dat file.
+
+    Non-uniform axes (log, dB, .. spacing) take their coordinates
+    from the '#values' lines of the .meta.txt.
+    '''
+    def __init__(self, directory, cache=True, partial=False, sidecar=True):
         if not os.path.isdir(directory):
             raise ValueError(f"The provided path '{directory}' is not a valid directory.")
         
@@ -14,9 +89,18 @@ class Data2D:
         self.Y = {}
         self.numeric_columns = {}
         self.num_data_columns = {}
+        self.cache = cache
+        self.partial = partial
+        self.sidecar = sidecar
+        self._from_sidecar = False
+        self._sidecar_checked = None
+        self._columns = None
+        self._nrows = 0
+        self._parsed_bytes = 0
         self._load_metadata_and_columns()
         self._X()
         self._Y()
+        self._Y_full = self.Y
 
 
     def _load_metadata_and_columns(self):
@@ -44,6 +128,7 @@ class Data2D:
         # Process single .meta.txt file
         meta_file = os.path.join(self.directory, meta_files[0])
         self.meta_data = self._parse_meta_file(meta_file)
+        self._values = _axis_values(meta_file)
 
         # Process single .dat file
         self.data_file = os.path.join(self.directory, dat_files[0])
@@ -89,12 +174,17 @@ class Data2D:
         meta_in, _, _ = self.meta_data
         npts, start, stop = meta_in[:3]
         self.X = np.linspace(start, stop, npts)
+        if 'inner' in self._values:
+            self.X = self._values['inner']
         
 
     def _X(self):
         _, meta_out, _ = self.meta_data
         npts, start, stop = meta_out[:3]
         self.Y = np.linspace(start, stop, npts)
+        if 'outer' in self._values:
+            # same last to first order as the #Outer block
+            self.Y = self._values['outer'][::-1]
     
     def read_column(self, column_index, **kwargs):
         """
@@ -107,6 +197,7 @@ class Data2D:
             The index of the column to read (0-based).
         **kwargs : dict
             Additional keyword arguments to pass to np.loadtxt, such as `delimiter`, `unpack`, etc.
+            Without kwargs the column comes from the parsed/cached array.
     
         Returns
         -------
@@ -122,10 +213,22 @@ class Data2D:
         # Extract inner and outer dimensions from metadata
         meta_in, meta_out, dims = self.meta_data
         inner_npts = len(self.X)
-        outer_npts = len(self.Y)
+        outer_npts = len(self._Y_full)
     
 
-        data = np.loadtxt(self.data_file, usecols=[column_index], **kwargs)
+        if kwargs:
+            data = np.loadtxt(self.data_file, usecols=[column_index], **kwargs)
+        else:
+            # copy, so that the cached array can not be modified
+            data = np.array(self._read_columns()[column_index])
+
+        if self.partial and len(data) <= inner_npts * outer_npts:
+            # completed outer rows, NaN-padding the last partial one
+            rows = -(-len(data) // inner_npts)
+            data = np.concatenate([data, np.full(rows*inner_npts - len(data), np.nan)])
+            # #Outer runs last to first, the measured rows are at the end
+            self.Y = self._Y_full[len(self._Y_full)-rows:]
+            outer_npts = rows
     
         # Ensure data size matches the expected size
         if len(data) != inner_npts * outer_npts:
@@ -136,10 +239,384 @@ class Data2D:
     
     def Z(self, column_index, **kwargs):
         return self.read_column(column_index, **kwargs)
+
+    def _cache_files(self):
+        base = self.data_file[:-4]
+        return base+'.cache.npy', base+'.cache.json'
+
+    def _cache_key(self):
+        st = os.stat(self.data_file)
+        return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    def _read_columns(self):
+        '''
+        All columns of the .dat file as a (numeric_columns, rows) array.
+        '''
+        if self._columns is not None:
+            return self._columns[:, :self._nrows]
+
+        side = self._read_sidecar()
+        if side is not None:
+            self._columns = side
+            self._nrows = side.shape[1]
+            self._from_sidecar = True
+            return side
+
+        cache_npy, cache_json = self._cache_files()
+        key = self._cache_key()
+        if self.cache and os.path.exists(cache_npy) and os.path.exists(cache_json):
+            with open(cache_json, 'r') as fl:
+                saved = json.load(fl)
+            if all(saved.get(k) == v for k, v in key.items()):
+                self._columns = np.load(cache_npy, mmap_mode='r')
+                self._nrows = self._columns.shape[1]
+                self._parsed_bytes = saved.get('parsed', key['size'])
+                return self._columns
+
+        self._append_columns(self._parse_from(0))
+        if self.cache:
+            try:
+                np.save(cache_npy, self._columns[:, :self._nrows])
+                with open(cache_json, 'w') as fl:
+                    json.dump(dict(key, parsed=self._parsed_bytes), fl)
+            except OSError:
+                pass  # read-only data directory, keep the in-memory copy
+        return self._columns[:, :self._nrows]
+
+    def _read_sidecar(self):
+        '''
+        (numeric_columns, rows) view of <name>.bin, or None if there
+        is no usable sidecar. The sidecar is used only if the size
+        and mtime of the .dat recorded in its header match, or else
+        if it has as many rows as the .dat (e.g. the .dat was edited,
+        or the sidecar was switched on partway through the run).
+        '''
+        sidecar_file = self.data_file[:-4]+'.bin'
+        if not (self.sidecar and os.path.exists(sidecar_file)
+                and os.path.exists(sidecar_file+'.json')):
+            return None
+        data, header = read_sidecar(sidecar_file)
+        if header.get('columns') != self.numeric_columns:
+            return None
+        key = self._cache_key()
+        if header.get('dat') != key:
+            checked = (key, data.shape[0])
+            if self._sidecar_checked != checked:
+                if data.shape[0] != self._count_rows():
+                    return None
+                self._sidecar_checked = checked
+        return data.T
+
+    def _count_rows(self):
+        '''
+        Number of complete data lines in the .dat file, from the
+        first byte of every line, without parsing.
+        '''
+        rows = 0
+        prev = 10  # the file starts a line
+        first = None
+        with open(self.data_file, 'rb') as fl:
+            for chunk in iter(lambda: fl.read(2**24), b''):
+                arr = np.frombuffer(chunk, dtype=np.uint8)
+                starts = np.flatnonzero(np.concatenate([[prev], arr[:-1]]) == 10)
+                if len(starts):
+                    heads = arr[starts]
+                    rows += np.count_nonzero((heads != ord('#')) & (heads != 10) & (heads != 13))
+                    first = heads[-1]
+                prev = arr[-1]
+        if prev != 10 and first not in (None, ord('#'), 13):
+            rows -= 1  # last line without newline, still writing
+        return rows
+
+    def _parse_from(self, offset):
+        '''
+        Parse the complete lines of the .dat file after byte offset.
+        A last line without newline (sweep still writing) is left
+        for the next call.
+        '''
+        with open(self.data_file, 'rb') as fl:
+            fl.seek(offset)
+            text = fl.read()
+        end = text.rfind(b'\n') + 1
+        self._parsed_bytes = offset + end
+        if not text[:end].strip():
+            return np.zeros((self.numeric_columns, 0))
+        data = np.loadtxt(io.StringIO(text[:end].decode()), ndmin=2)
+        return np.ascontiguousarray(data.T)
+
+    def _append_columns(self, new):
+        # grows the column array by doubling, so that refresh()
+        # does not copy the whole dataset for every new block
+        need = self._nrows + new.shape[1]
+        if self._columns is None or need > self._columns.shape[1] or not self._columns.flags.writeable:
+            capacity = need if self._columns is None else max(need, 2*self._columns.shape[1])
+            columns = np.empty((new.shape[0], capacity))
+            if self._columns is not None:
+                columns[:, :self._nrows] = self._columns[:, :self._nrows]
+            self._columns = columns
+        self._columns[:, self._nrows:need] = new
+        self._nrows = need
+
+    def refresh(self):
+        '''
+        Parse only the rows appended to the .dat file since the
+        last read, for live monitoring of a running sweep.
+        Returns the number of new rows.
+        '''
+        if self._columns is None:
+            return self._read_columns().shape[1]
+        if self._from_sidecar:
+            # map the grown file again
+            rows = self._nrows
+            self._columns = None
+            return self._read_columns().shape[1] - rows
+        if os.path.getsize(self.data_file) < self._parsed_bytes:
+            # file was rewritten, start over
+            self._columns = None
+            self._nrows = 0
+            return self._read_columns().shape[1]
+        new = self._parse_from(self._parsed_bytes)
+        if new.shape[1]:
+            self._append_columns(new)
+        return new.shape[1]
     
     
     
     
+class DataND(Data2D):
+    '''
+    Reader for sweeps with up to three axes (#Inner, #Outer and
+    #Outmost in the .meta.txt), with lazy, labelled slicing.
+
+    The .dat file is not parsed when the directory is opened.
+    A row-offset index (byte position of every data row) is built
+    on the first access, and isel/sel read only the byte ranges
+    of the selected rows. refresh() extends the index with the
+    rows appended by a running sweep.
+
+    d = DataND(path)
+    d.dims                                  # ('outmost', 'outer', 'inner')
+    d.isel(2, outmost=0, outer=10)          # one trace of column 2
+    d.sel(3, inner=5.2e9, method='nearest') # linecut along outer/outmost
+
+    Coordinates follow the order in which the rows were measured.
+    inner is Data2D.X, outer is Data2D.Y reversed (Data2D.Y keeps
+    the last, first order of the #Outer block).
+    '''
+    dims = ('outmost', 'outer', 'inner')
+
+    # bytes scanned per step while building the row-offset index
+    _SCAN_BYTES = 2**26
+
+    def __init__(self, directory, cache=True, sidecar=True):
+        super().__init__(directory, cache=cache, sidecar=sidecar)
+        self.axes = self._parse_axes(self._meta_file())
+        self.shape = tuple(len(self.axes[dim][1]) for dim in self.dims)
+        self._offsets = None
+        self._ends = None
+        self._indexed_bytes = 0
+        self._sidecar_rows = 0
+
+    def _meta_file(self):
+        meta_files = [f for f in os.listdir(self.directory) if f.endswith(".meta.txt")]
+        return os.path.join(self.directory, meta_files[0])
+
+    def _parse_axes(self, filepath):
+        '''
+        {dim: (name, coordinates)} for inner, outer and outmost,
+        the coordinates in the order of the rows in the .dat.
+        Missing axes have a single point.
+        '''
+        with open(filepath, 'r') as file:
+            lines = [line.strip() for line in file if not line.startswith('#') and line.strip()]
+
+        values = _axis_values(filepath)
+        axes = {}
+        for i, dim in enumerate(('inner', 'outer', 'outmost')):
+            if len(lines) >= 4*(i+1):
+                npts, start, stop, name = lines[4*i:4*i+4]
+                if dim == 'outer':
+                    # meta_quick and _metagen write #Outer as npts, last, first
+                    start, stop = stop, start
+                axes[dim] = (name, values.get(dim, np.linspace(float(start), float(stop), int(npts))))
+            else:
+                axes[dim] = ('Nothing', np.zeros(1))
+        return axes
+
+    def _build_index(self, start=0):
+        '''
+        Byte offsets of the start and end of every data row,
+        skipping blank and comment lines. With start > 0 only the
+        bytes after start are scanned and the rows are appended.
+        '''
+        starts, ends = [], []
+        pos = start
+        line_start = start
+        with open(self.data_file, 'rb') as fl:
+            fl.seek(start)
+            while True:
+                chunk = fl.read(self._SCAN_BYTES)
+                if not chunk:
+                    break
+                nl = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10) + pos
+                if len(nl):
+                    starts.append(np.concatenate([[line_start], nl[:-1]+1]))
+                    ends.append(nl)
+                    line_start = nl[-1]+1
+                pos += len(chunk)
+        starts = np.concatenate(starts + [np.zeros(0)]).astype(np.int64)
+        ends = np.concatenate(ends + [np.zeros(0)]).astype(np.int64)
+        # bytes up to the last newline, a last line without newline
+        # (sweep still writing) is scanned again by refresh()
+        self._indexed_bytes = line_start
+        if line_start < pos:
+            starts = np.append(starts, line_start)
+            ends = np.append(ends, pos)
+
+        # keep data rows only
+        nonempty = ends > starts
+        starts, ends = starts[nonempty], ends[nonempty]
+        if len(starts):
+            first = np.memmap(self.data_file, dtype=np.uint8, mode='r')[starts]
+            data_rows = (first != ord('#')) & (first != ord('\r'))
+            starts, ends = starts[data_rows], ends[data_rows]
+        if start and self._offsets is not None:
+            keep = self._offsets < start
+            starts = np.concatenate([self._offsets[keep], starts])
+            ends = np.concatenate([self._ends[keep], ends])
+        self._offsets = starts
+        self._ends = ends
+
+    def refresh(self):
+        '''
+        Extend the row-offset index with the rows appended to the
+        .dat file since the last call, scanning only the new bytes.
+        The columns are not loaded (only updated if read_column
+        already loaded them). Returns the number of new rows.
+        '''
+        if self._columns is not None:
+            super().refresh()
+        side = self._read_sidecar()
+        if side is not None:
+            rows, self._sidecar_rows = self._sidecar_rows, side.shape[1]
+            return self._sidecar_rows - rows
+        if self._offsets is None:
+            self._build_index()
+            return len(self._offsets)
+        rows = len(self._offsets)
+        if os.path.getsize(self.data_file) < self._indexed_bytes:
+            # file was rewritten, start over
+            self._build_index()
+            return len(self._offsets)
+        self._build_index(self._indexed_bytes)
+        return len(self._offsets) - rows
+
+    def row_offsets(self):
+        if self._offsets is None:
+            self._build_index()
+        return self._offsets
+
+    def _read_rows(self, rows, column_index):
+        '''
+        Values of one column for the given (sorted) row numbers,
+        reading each run of consecutive rows with a single seek.
+        With a sidecar the values are taken from its memmap.
+        '''
+        side = self._read_sidecar()
+        if side is not None:
+            if len(rows) and rows[-1] >= side.shape[1]:
+                raise ValueError(f"Row {rows[-1]} is beyond the {side.shape[1]} rows in the sidecar.")
+            return np.array(side[column_index, rows])
+        offsets = self.row_offsets()
+        if len(rows) and rows[-1] >= len(offsets):
+            raise ValueError(f"Row {rows[-1]} is beyond the {len(offsets)} rows in the .dat file.")
+        out = np.empty(len(rows))
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        with open(self.data_file, 'rb') as fl:
+            for run in np.split(np.arange(len(rows)), breaks):
+                if not len(run):
+                    continue
+                r0, r1 = rows[run[0]], rows[run[-1]]
+                fl.seek(offsets[r0])
+                text = fl.read(self._ends[r1] - offsets[r0]).decode()
+                out[run] = np.loadtxt(io.StringIO(text), usecols=[column_index], ndmin=1)
+        return out
+
+    def isel(self, column_index, **indexers):
+        '''
+        Lazy selection by integer index or slice along
+        'inner', 'outer' and 'outmost'. Returns an xr.DataArray
+        with the remaining axes as labelled coordinates.
+        '''
+        if not (0 <= column_index < self.numeric_columns):
+            raise ValueError(f"Invalid column index {column_index}. Must be between 0 and {self.numeric_columns - 1}.")
+        for dim in indexers:
+            if dim not in self.dims:
+                raise ValueError(f"Unknown dimension '{dim}'. Use one of {self.dims}.")
+
+        index = []
+        for dim, n in zip(self.dims, self.shape):
+            idx = indexers.get(dim, slice(None))
+            index.append(np.arange(n)[idx])
+        grid = np.ix_(*[np.atleast_1d(i) for i in index])
+        rows = np.ravel_multi_index(grid, self.shape).ravel()
+        order = np.argsort(rows)
+        values = np.empty(len(rows))
+        values[order] = self._read_rows(rows[order], column_index)
+        values = values.reshape([np.size(i) for i in index])
+
+        keep = [dim for dim, i in zip(self.dims, index) if np.ndim(i)]
+        coords = {dim: self.axes[dim][1][i] for dim, i in zip(self.dims, index)}
+        data = xr.DataArray(values, dims=self.dims, coords=coords, name=f'Z{column_index}')
+        data = data.squeeze([dim for dim in self.dims if dim not in keep])
+        for dim in self.dims:
+            data[dim].attrs['name'] = self.axes[dim][0]
+        return data
+
+    def sel(self, column_index, method=None, **indexers):
+        '''
+        Same as isel, with coordinate values instead of indices.
+        method='nearest' picks the closest coordinate.
+        '''
+        positions = {}
+        for dim, label in indexers.items():
+            if dim not in self.dims:
+                raise ValueError(f"Unknown dimension '{dim}'. Use one of {self.dims}.")
+            positions[dim] = self._position(dim, label, method)
+        return self.isel(column_index, **positions)
+
+    def _position(self, dim, label, method):
+        coord = self.axes[dim][1]
+        if isinstance(label, slice):
+            lo, hi = label.start, label.stop
+            mask = np.ones(len(coord), dtype=bool)
+            if lo is not None:
+                mask &= coord >= min(lo, hi if hi is not None else lo)
+            if hi is not None:
+                mask &= coord <= max(hi, lo if lo is not None else hi)
+            return np.flatnonzero(mask)
+        if method == 'nearest':
+            return int(np.argmin(np.abs(coord - label)))
+        match = np.flatnonzero(np.isclose(coord, label, rtol=1e-12, atol=0))
+        if not len(match):
+            raise KeyError(f"{label} not found along '{dim}', use method='nearest'.")
+        return int(match[0])
+
+    def read_column(self, column_index, **kwargs):
+        '''
+        Full column reshaped to (outmost, outer, inner).
+        '''
+        if not (0 <= column_index < self.numeric_columns):
+            raise ValueError(f"Invalid column index {column_index}. Must be between 0 and {self.numeric_columns - 1}.")
+        if kwargs:
+            data = np.loadtxt(self.data_file, usecols=[column_index], **kwargs)
+        else:
+            data = np.array(self._read_columns()[column_index])
+        if len(data) != np.prod(self.shape):
+            raise ValueError(f"Data size {len(data)} does not match the expected size {np.prod(self.shape)}.")
+        return data.reshape(self.shape)
+
+
 def SaveNpy(dir_path):
     '''
     Parameters
@@ -157,7 +634,7 @@ def SaveNpy(dir_path):
 
     '''
     
-    d = Data2D(dir_path)
+    d = Data2D(dir_path, cache=False)
     
     # Saving X array
     filename_x = d.data_file[:-4]+'_X1'+'.npy'
@@ -178,12 +655,30 @@ def SaveNpy(dir_path):
     
 
 
-def SaveHD5(dir_path):
+def SaveHD5(dir_path, compression=None, level=None, shuffle=False,
+            chunks=None, dtype=None, fletcher32=False, checksum=True):
     '''
 
     Parameters
     ----------
     dir_path : directoty where .dat and .meta.txt file lives.
+    compression : None (default), 'zlib'/'gzip', 'lzf', 'szip', the
+        integer id of a registered HDF5 filter (with its options as
+        level), or a filter object of hdf5plugin, e.g.
+        compression=hdf5plugin.Blosc(cname='zstd', clevel=5)
+        after import hdf5plugin. h5py does not know filters by
+        name, compression='blosc' raises.
+    level : compression level, 0-9 for zlib (default 4), or the
+        compression_opts of an integer filter id.
+    shuffle : byte-shuffle filter, usually improves the compression
+        of float data.
+    chunks : chunk shape of the Z arrays (Y, X). Default: one
+        outer row, (1, len(X)), when compressed, else contiguous.
+    dtype : e.g. 'float32' to halve the size of the Z arrays.
+    fletcher32 : HDF5 checksum of every chunk, checked on read.
+    checksum : record the sha256 of the .dat and .h5 files in
+        <name>.sha256 next to them, in the format of sha256sum
+        (see VerifyChecksums). The .meta.txt is not touched.
 
     Returns
     -------
@@ -197,7 +692,7 @@ def SaveHD5(dir_path):
     Y_values = ds_loaded["Y"].values
     Z2_array = ds_loaded["Z2"].values
     '''
-    d = Data2D(dir_path)
+    d = Data2D(dir_path, cache=False)
     
     # Combining different Z columns
     data_vars = {}
@@ -206,23 +701,176 @@ def SaveHD5(dir_path):
         
     # Creating a Xarray dataset with coordinates
     ds = xr.Dataset(data_vars, coords = {"Y": d.Y, "X": d.X})
+
+    encoding = {}
+    if compression == 'zlib':
+        compression = 'gzip'
+    if compression is not None and chunks is None:
+        chunks = (1, len(d.X))
+    for name in data_vars:
+        enc = {}
+        if isinstance(compression, Mapping):
+            # hdf5plugin filter: {'compression': id, 'compression_opts': (..)}
+            enc.update(compression)
+        elif compression is not None:
+            enc['compression'] = compression
+            if level is not None or compression == 'gzip':
+                enc['compression_opts'] = 4 if level is None else level
+        if shuffle:
+            enc['shuffle'] = True
+        if fletcher32:
+            enc['fletcher32'] = True
+        if chunks is not None:
+            enc['chunksizes'] = tuple(min(c, n) for c, n in zip(chunks, (len(d.Y), len(d.X))))
+        if dtype is not None:
+            enc['dtype'] = np.dtype(dtype)
+        encoding[name] = enc
     
     # Writing the Dataset to disk using h5 format
     file_name = d.data_file[:-4]+'.h5'
-    ds.to_netcdf(file_name, engine="h5netcdf")
+    ds.to_netcdf(file_name, engine="h5netcdf", encoding=encoding)
+    if checksum:
+        _record_checksums(d.data_file[:-4]+'.sha256', [d.data_file, file_name])
     print('.h5 written to disk.')
     pass
 
 
+def _file_checksum(filepath, block=2**22):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as fl:
+        for chunk in iter(lambda: fl.read(block), b''):
+            h.update(chunk)
+    return h.hexdigest()
 
 
+def _read_checksums(sha_file):
+    # {file name: hash} of a sha256sum style file
+    checksums = {}
+    if os.path.exists(sha_file):
+        with open(sha_file, 'r') as fl:
+            for line in fl:
+                if line.strip():
+                    digest, name = line.rstrip('\n').split(None, 1)
+                    checksums[name.lstrip('*')] = digest
+    return checksums
 
 
+def _record_checksums(sha_file, files):
+    '''
+    Write '<hash>  <file name>' lines (sha256sum format, so
+    sha256sum -c works as well) to sha_file, replacing older
+    lines for the same files.
+    '''
+    checksums = _read_checksums(sha_file)
+    checksums.update({os.path.basename(f): _file_checksum(f) for f in files})
+    with open(sha_file, 'w') as fl:
+        fl.write(''.join(f'{digest}  {name}\n' for name, digest in checksums.items()))
 
 
+def VerifyChecksums(dir_path):
+    '''
+    Compare the files in dir_path with the sha256 recorded in the
+    <name>.sha256 files written by SaveHD5.
 
+    Returns
+    -------
+    dict {file name: True/False}, False also for a missing file.
+    '''
+    result = {}
+    for sha_file in sorted(f for f in os.listdir(dir_path) if f.endswith('.sha256')):
+        for name, digest in _read_checksums(os.path.join(dir_path, sha_file)).items():
+            filepath = os.path.join(dir_path, name)
+            result[name] = os.path.exists(filepath) and _file_checksum(filepath) == digest
+    return result
 
 
+def _measurement_dirs(root):
+    '''
+    Directories below root with one .dat and one .meta.txt file.
+    '''
+    for dirpath, dirnames, filenames in os.walk(root):
+        dat_files = [f for f in filenames if f.endswith('.dat')]
+        meta_files = [f for f in filenames if f.endswith('.meta.txt')]
+        if len(dat_files) == 1 and len(meta_files) == 1:
+            yield dirpath, os.path.join(dirpath, dat_files[0]), os.path.join(dirpath, meta_files[0])
+
+
+def _is_converted(dat_file, meta_file, fmt):
+    base = dat_file[:-4]
+    if fmt == 'h5':
+        outputs = [base+'.h5']
+    else:
+        outputs = [base+'_X1.npy', base+'_Y2.npy', base+'_Z2.npy']
+    if not all(os.path.exists(f) for f in outputs):
+        return False
+    newest_input = max(os.path.getmtime(dat_file), os.path.getmtime(meta_file))
+    return min(os.path.getmtime(f) for f in outputs) >= newest_input
+
+
+def _convert_dir(dir_path, fmt, options):
+    # runs in a worker process, returns the traceback on failure
+    try:
+        with redirect_stdout(io.StringIO()):
+            if fmt == 'h5':
+                SaveHD5(dir_path, **options)
+            else:
+                SaveNpy(dir_path)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def SaveTree(root, fmt='h5', workers=None, force=False, **options):
+    '''
+    Parameters
+    ----------
+    root : top directory, e.g. 'D:\\Data'. Every directory below it
+        with one .dat and one .meta.txt file is converted.
+    fmt : 'h5' (SaveHD5) or 'npy' (SaveNpy)
+    workers : number of processes, default os.cpu_count()
+    force : convert also directories whose output is newer
+        than the .dat and .meta.txt files
+    options : passed to SaveHD5, e.g. compression='zlib'
 
+    Returns
+    -------
+    dict with lists 'converted', 'skipped' and a dict 'failed'
+    {directory: traceback}
 
-
+    On Windows call it under  if __name__ == '__main__':
+    since the worker processes import the calling script.
+    '''
+    if fmt not in ('h5', 'npy'):
+        raise ValueError(f"Unsupported format '{fmt}'. Use 'h5' or 'npy'.")
+    if options and fmt != 'h5':
+        raise ValueError("SaveHD5 options can only be used with fmt='h5'.")
+
+    result = {'converted': [], 'skipped': [], 'failed': {}}
+    todo = []
+    for dir_path, dat_file, meta_file in _measurement_dirs(root):
+        if not force and _is_converted(dat_file, meta_file, fmt):
+            result['skipped'].append(dir_path)
+        else:
+            todo.append(dir_path)
+
+    print(f'{len(todo)} directories to convert, {len(result["skipped"])} already converted.')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_convert_dir, dir_path, fmt, options): dir_path for dir_path in todo}
+        for i, future in enumerate(as_completed(futures), start=1):
+            dir_path = futures[future]
+            try:
+                error = future.result()
+            except Exception:
+                error = traceback.format_exc()
+            if error is None:
+                result['converted'].append(dir_path)
+                print(f'[{i}/{len(todo)}] {dir_path}')
+            else:
+                result['failed'][dir_path] = error
+                print(f'[{i}/{len(todo)}] FAILED {dir_path}')
+
+    print(f'Converted {len(result["converted"])}, skipped {len(result["skipped"])}, '
+          f'failed {len(result["failed"])}.')
+    for dir_path, error in result['failed'].items():
+        print(f'\n{dir_path}\n{error.strip().splitlines()[-1]}')
+    return result
@@ -0,0 +1,181 @@
+import os
+import warnings
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import xarray as xr
+from scipy.optimize import OptimizeWarning
+
+from vslab.analysis.fitter import Fitter
+from vslab.analysis.fitter_complex import FitterComplex
+
+
+# status of every row in the result of fit_many
+FIT_OK = 0
+FIT_NOT_CONVERGED = 1
+FIT_ERROR = 2
+FIT_NO_ERRORS = 3
+FIT_NAN_DATA = 4
+
+STATUS = {FIT_OK: 'ok',
+          FIT_NOT_CONVERGED: 'not converged',
+          FIT_ERROR: 'error',
+          FIT_NO_ERRORS: 'covariance could not be estimated',
+          FIT_NAN_DATA: 'NaN in data'}
+
+
+def _make_fitter(model, complex_data):
+    return FitterComplex(model) if complex_data else Fitter(model)
+
+
+def _param_names(fitter):
+    if isinstance(fitter, FitterComplex):
+        return fitter.param_names()
+    code = fitter.model_func.__code__
+    return list(code.co_varnames[1:code.co_argcount])
+
+
+def _fit_one(fitter, complex_data, x, y, guess):
+    '''
+    One fit, starting from guess (None: initial_guess).
+    Returns (popt, perr, status, message, rms residual).
+    '''
+    npar = len(_param_names(fitter))
+    failed = np.full(npar, np.nan)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', OptimizeWarning)
+            if guess is None:
+                popt, perr = fitter.fit(x, y)
+            elif complex_data:
+                popt, perr = fitter.fit(x, y, auto_guess=False, guess_val=guess)
+            else:
+                popt, perr = fitter.fit(x, y, auto_guess=False, guess=guess)
+    except RuntimeError as e:
+        return failed, failed, FIT_NOT_CONVERGED, str(e), np.inf
+    except Exception:
+        return failed, failed, FIT_ERROR, traceback.format_exc().strip().splitlines()[-1], np.inf
+    popt = np.asarray(popt, dtype=float)
+    perr = np.asarray(perr, dtype=float)
+    model = fitter.model_eval if complex_data else fitter.model_func
+    rms = np.sqrt(np.mean(np.abs(model(x, *popt) - y)**2))
+    status = FIT_OK if np.all(np.isfinite(perr)) else FIT_NO_ERRORS
+    return popt, perr, status, '', rms
+
+
+def _fit_rows(model, complex_data, x, rows, guess, warm_start=False, reset=3.):
+    '''
+    Fit a block of rows in a worker process.
+    Returns a list of (popt, perr, status, message, warm).
+
+    With warm_start, each row starts from the popt of the row before.
+    If that fit fails, or its rms residual is more than reset times
+    the one of the row before, the row is fitted again from guess /
+    initial_guess and the better of the two fits is kept.
+    '''
+    fitter = _make_fitter(model, complex_data)
+    npar = len(_param_names(fitter))
+    results = []
+    last_popt, last_rms = None, None
+    for y in rows:
+        if not np.all(np.isfinite(y)):
+            results.append((np.full(npar, np.nan), np.full(npar, np.nan), FIT_NAN_DATA, '', False))
+            continue
+        warm = None
+        if warm_start and last_popt is not None:
+            warm = _fit_one(fitter, complex_data, x, y, last_popt)
+        if warm is not None and warm[2] == FIT_OK and warm[4] <= reset*last_rms:
+            fit, used_warm = warm, True
+        else:
+            fit, used_warm = _fit_one(fitter, complex_data, x, y, guess), False
+            if warm is not None and warm[2] == FIT_OK and warm[4] < fit[4]:
+                fit, used_warm = warm, True
+        if fit[2] == FIT_OK:
+            last_popt, last_rms = fit[0], fit[4]
+        results.append(fit[:4] + (used_warm,))
+    return results
+
+
+def fit_many(x, Y, model, outer=None, guess=None, workers=None, rows_per_task=None,
+             warm_start=False, reset=3., batch=False):
+    '''
+    Fit every row of a 2D sweep with the same model, in parallel.
+
+    Parameters
+    ----------
+    x : inner axis, e.g. Data2D.X (frequency)
+    Y : (len(outer), len(x)) array, e.g. Data2D.Z(2). Complex Y
+        (I + 1j*Q) is fitted with FitterComplex, real Y with Fitter.
+    model : model name of Fitter / FitterComplex, e.g. 'S21sideCable'
+    outer : coordinates of the rows, e.g. Data2D.Y. Default 0, 1, ..
+    guess : list of starting values used for every row.
+        None (default) uses initial_guess of each row.
+    workers : number of processes, default os.cpu_count().
+        workers=1 fits in this process.
+    rows_per_task : rows sent to a worker at once, default such
+        that every worker gets about 4 tasks (one contiguous block
+        per worker with warm_start).
+    warm_start : start each row from the result of the row before
+        (in power or flux sweeps neighbouring rows are nearly the
+        same), instead of initial_guess. The chain restarts from
+        the heuristic guess when a fit fails or its rms residual
+        grows by more than reset times. Use workers=1 for a single
+        chain through the whole sweep.
+    batch : fit all rows together in this process with the batched
+        Levenberg-Marquardt solver (Fitter.fit_batch) instead of one
+        curve_fit per row. workers and warm_start are not used.
+
+    Returns
+    -------
+    xr.Dataset along 'outer' with one variable per fit parameter,
+    its error as <name>_err, 'status' (see STATUS, 0 is ok) and
+    'message' with the error of failed rows, and 'warm_start',
+    True for the rows fitted from the row before. Failed rows are NaN.
+
+    res = fit_many(da.X, s21, 'S21sideCable', outer=da.Y)
+    res['k'].where(res.status == 0).plot()
+
+    On Windows call it under  if __name__ == '__main__':
+    since the worker processes import the calling script.
+    '''
+    x = np.asarray(x)
+    Y = np.atleast_2d(np.asarray(Y))
+    if Y.shape[1] != len(x):
+        raise ValueError(f"Y has {Y.shape[1]} points per row, x has {len(x)}.")
+    complex_data = np.iscomplexobj(Y)
+    names = _param_names(_make_fitter(model, complex_data))
+    if outer is None:
+        outer = np.arange(Y.shape[0])
+    if len(outer) != Y.shape[0]:
+        raise ValueError(f"outer has {len(outer)} values, Y has {Y.shape[0]} rows.")
+
+    workers = workers or os.cpu_count() or 1
+    if rows_per_task is None:
+        tasks = workers if warm_start else 4*workers
+        rows_per_task = max(1, -(-Y.shape[0] // tasks))
+    blocks = [Y[i:i+rows_per_task] for i in range(0, Y.shape[0], rows_per_task)]
+
+    if batch:
+        fitter = _make_fitter(model, complex_data)
+        popt, perr, status = fitter.fit_batch(x, Y, guess=guess)
+        results = [(popt[i], perr[i], status[i], fitter.messages[i], False) for i in range(len(Y))]
+    elif workers == 1:
+        results = [r for rows in blocks for r in _fit_rows(model, complex_data, x, rows, guess, warm_start, reset)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_fit_rows, model, complex_data, x, rows, guess, warm_start, reset) for rows in blocks]
+            results = [r for future in futures for r in future.result()]
+
+    popt = np.array([r[0] for r in results])
+    perr = np.array([r[1] for r in results])
+    data_vars = {}
+    for i, name in enumerate(names):
+        data_vars[name] = ('outer', popt[:, i])
+        data_vars[name+'_err'] = ('outer', perr[:, i])
+    data_vars['status'] = ('outer', np.array([r[2] for r in results], dtype=np.int8))
+    data_vars['message'] = ('outer', np.array([r[3] for r in results], dtype=str))
+    data_vars['warm_start'] = ('outer', np.array([r[4] for r in results], dtype=bool))
+    attrs = {'model': model,
+             'fitter': 'FitterComplex' if complex_data else 'Fitter',
+             'status_codes': ', '.join(f'{k}: {v}' for k, v in STATUS.items())}
+    return xr.Dataset(data_vars, coords={'outer': np.asarray(outer)}, attrs=attrs)
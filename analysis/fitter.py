@@ -4,9 +4,16 @@ import pickle
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 from scipy.signal import find_peaks
+from vslab.analysis.batch_lm import batch_lm, start_values
 
 
 class Fitter:
+    # models that fit faster with their analytic Jacobian than with
+    # finite differences (example codes/fit_jacobian_benchmark.py);
+    # for the others the extra Jacobian calls cost about as much as
+    # the model calls they save
+    analytic_jac = ('S11', 'S11complex', 'S21side', 'S21sideComplex', 'S21sideDCM')
+
     def __init__(self, model_type="lorentzian"):
         self.models = {
             "S21": self.S21,
@@ -20,12 +27,27 @@ class Fitter:
             "lorentzian": self.lorentzian,
             "exponential": self.exponential,
         }
+        # analytic Jacobians (len(x), n_params) passed to curve_fit
+        self.jacobians = {
+            "S21": self.S21_jac,
+            "S11": self.S11_jac,
+            "S11complex": self.S11complex_jac,
+            "S21side": self.S21side_jac,
+            "S21sideComplex": self.S21sideComplex_jac,
+            "S21sideDCM": self.S21sideDCM_jac,
+            "linear": self.linear_jac,
+            "quadratic": self.quadratic_jac,
+            "lorentzian": self.lorentzian_jac,
+            "exponential": self.exponential_jac,
+        }
 
         if model_type not in self.models:
             raise ValueError(f"Unsupported model type '{model_type}'.")
         
         self.model_type = model_type
         self.model_func = self.models[model_type]
+        self.model_jac = self.jacobians.get(model_type)
+        self.jac_default = model_type in self.analytic_jac
         self.popt = None
         self.pcov = None
         self.perr = None
@@ -72,6 +94,111 @@ class Fitter:
     def linear(x, m, b):
         return m * x + b
 
+    # --- Jacobians ---
+    # d|f|/dp = Re(conj(f) df/dp)/|f| for the models fitted in magnitude,
+    # dval are the derivatives df/dp of the complex value inside np.abs.
+    # Rows are filled in a (n_params, len(x)) array, its transpose is
+    # the Fortran ordered Jacobian that MINPACK uses without a copy.
+    # With (K, 1) parameter columns (fit_batch) the result is (K, len(x), n_params).
+    @staticmethod
+    def _abs_jac(val, dval):
+        inv = 1/np.maximum(np.abs(val), np.finfo(float).tiny)
+        re = val.real*inv
+        im = val.imag*inv
+        jac = np.empty((len(dval),) + val.shape)
+        for row, d in zip(jac, dval):
+            np.multiply(re, d.real, out=row)
+            row += im*d.imag
+        return np.moveaxis(jac, 0, -1)
+
+    @staticmethod
+    def S21_jac(x, x0, k, amp):
+        den = k + 2j*(x-x0)
+        val = amp*k/den
+        q = val/den
+        return Fitter._abs_jac(val, [2j*q,
+                                     (2j/k)*(x-x0)*q,
+                                     val/amp])
+
+    @staticmethod
+    def S11_jac(x, x0, ke, k, amp):
+        den = k + 2j*(x-x0)
+        g = 2*ke/den
+        q = amp*g/den
+        val = amp*(1 - g)
+        return Fitter._abs_jac(val, [-2j*q,
+                                     (-amp/ke)*g,
+                                     q,
+                                     1 - g])
+
+    @staticmethod
+    def S11complex_jac(x, x0, ke, k, amp, phi):
+        den = k + 2j*(x-x0)
+        g = 2*ke*np.exp(1j*phi)/den
+        q = amp*g/den
+        val = amp*(1 - g)
+        return Fitter._abs_jac(val, [-2j*q,
+                                     (-amp/ke)*g,
+                                     q,
+                                     1 - g,
+                                     -1j*amp*g])
+
+    @staticmethod
+    def S21side_jac(x, x0, ke, ki, amp):
+        den = ke + ki + 2j*(x-x0)
+        g = ke/den
+        q = amp*g/den
+        val = amp*(1 - g)
+        return Fitter._abs_jac(val, [-2j*q,
+                                     q - amp/den,
+                                     q,
+                                     1 - g])
+
+    @staticmethod
+    def S21sideComplex_jac(x, x0, ke, k, amp, phi):
+        den = k/2 - 1j*(x-x0)
+        g = 0.5*ke*np.exp(1j*phi)/den
+        q = amp*g/den
+        val = amp*(1 - g)
+        return Fitter._abs_jac(val, [1j*q,
+                                     (-amp/ke)*g,
+                                     0.5*q,
+                                     1 - g,
+                                     -1j*amp*g])
+
+    @staticmethod
+    def S21sideDCM_jac(x, x0, Qe, Q, amp, phi):
+        den = 1 + 1j*2*Q*(x-x0)/x0
+        g = (Q/Qe*np.exp(-1j*phi))/den
+        q = amp*g/den
+        val = amp*(1 - g)
+        return Fitter._abs_jac(val, [(-2j*Q/x0**2)*x*q,
+                                     (amp/Qe)*g,
+                                     (-amp/Q)*g + (2j/x0)*(x-x0)*q,
+                                     1 - g,
+                                     1j*amp*g])
+
+    @staticmethod
+    def lorentzian_jac(x, A, x0, w):
+        den = (x - x0)**2 + (w/2)**2
+        shape = (w/2)/den/np.pi
+        return np.stack([shape,
+                         A*shape*2*(x - x0)/den,
+                         A/np.pi*(0.5/den - (w/2)**2/den**2)], axis=-1)
+
+    @staticmethod
+    def quadratic_jac(x, a, b, c):
+        return np.stack([x**2, x, np.ones_like(x)], axis=-1)
+
+    @staticmethod
+    def exponential_jac(x, A, tau, C):
+        e = np.exp(-x / tau)
+        return np.stack([e, A*e*x/tau**2, np.ones_like(e)], axis=-1)
+
+    @staticmethod
+    def linear_jac(x, m, b):
+        return np.stack([x, np.ones_like(x)], axis=-1)
+
     # --- Initial Guess ---
     def initial_guess(self, x, y):
         def fwhm(x, y):
@@ -160,14 +287,22 @@ class Fitter:
             dir_name = None,
             file_index = 0,
             auto_guess=True,
-            guess = None):
+            guess = None,
+            jac = None):
+        '''
+        jac : True/False, use the analytic Jacobian of the model
+            instead of finite differences. The default None uses it
+            only for the models in Fitter.analytic_jac.
+        '''
         if auto_guess:
             p0 = self.initial_guess(x, y)
         else:
-            pass
-            # p0 = guess
+            p0 = guess
+        if jac is None:
+            jac = self.jac_default
 
-        self.popt, self.pcov = curve_fit(self.model_func, x, y, p0=p0)
+        self.popt, self.pcov = curve_fit(self.model_func, x, y, p0=p0,
+                                         jac=self.model_jac if jac else None)
         self.perr = np.sqrt(np.diag(self.pcov))
         
         if save:
@@ -182,6 +317,34 @@ class Fitter:
         return self.popt, self.perr
 
 
+    def fit_batch(self, x, Y, guess=None, **options):
+        '''
+        Fit every row of Y (K, len(x)) with the batched
+        Levenberg-Marquardt solver (analysis.batch_lm): all rows are
+        stepped together with NumPy arrays instead of one curve_fit
+        per row, which is much faster for many traces.
+
+        guess : None (initial_guess of every row), one list used for
+            all rows, or a (K, n_params) array.
+        options : max_iter, xtol, ftol, lam, chunk of batch_lm
+
+        Returns
+        -------
+        popt, perr : (K, n_params)
+        status : (K,), 0 for converged rows (see fit_batch.STATUS)
+
+        self.messages holds the reason for rows whose initial_guess
+        failed (status 2), '' for the other rows.
+        '''
+        if self.model_jac is None:
+            raise ValueError(f"'{self.model_type}' has no Jacobian for fit_batch.")
+        x = np.asarray(x, dtype=float)
+        Y = np.atleast_2d(np.asarray(Y, dtype=float))
+        npar = self.model_func.__code__.co_argcount - 1
+        P0, self.messages = start_values(self.initial_guess, x, Y, npar, guess)
+        popt, perr, status, _ = batch_lm(self.model_func, self.model_jac, x, Y, P0, **options)
+        return popt, perr, status
+
     def save_plot(self, x, y, 
                   dir_name,
                   file_index=0):
@@ -1,74 +1,80 @@
 import numpy as np
 import os
+import functools
 import pickle
 import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 from scipy.signal import find_peaks
 from vslab.analysis.fitter import Fitter
+from vslab.analysis.batch_lm import batch_lm, start_values
 
 class FitterComplex:
     '''
     To handle fitting of both the quadratures
     WHILE UPDATING, BE MINDFUL -- 
     1) rotation sense when entering model equation
-    2) model_func and model_eval are NEARLY IDENTICAL WITH 
-    MINOR BUT IMPORTANT CHANGE.
-    --> It ends with 'c'
+    2) Every model is defined once and returns the complex value.
+    model_eval is that function (used for plotting), model_func
+    the real view of it that curve_fit sees: the complex array
+    read as interleaved (re0, im0, re1, im1, ..) floats, so the
+    optimizer loop neither copies nor concatenates. The data are
+    viewed the same way in fit().
     
     '''
+    # models that fit faster with their analytic Jacobian than with
+    # finite differences (example codes/fit_jacobian_benchmark.py)
+    analytic_jac = ('S21side', 'S21sideCable', 'S21sideCableF')
+
     def __init__(self, model_type="S21"):
-        self.models = {"S21": [self.S21, self.S21c],
-                       "S21side": [self.S21side, self.S21sidec],
-                       "S21sideF": [self.S21sideF, self.S21sideFc],
-                       "S21sideCable": [self.S21sideCable, self.S21sideCablec],
-                       "S21sideCableF": [self.S21sideCableF, self.S21sideCableFc],
-                       "S11cable": [self.S11, self.S11c]
+        # model name: [complex model, analytic Jacobian]
+        self.models = {"S21": [self.S21, self.S21_jac],
+                       "S21side": [self.S21side, self.S21side_jac],
+                       "S21sideF": [self.S21sideF, self.S21sideF_jac],
+                       "S21sideCable": [self.S21sideCable, self.S21sideCable_jac],
+                       "S21sideCableF": [self.S21sideCableF, self.S21sideCableF_jac],
+                       "S11cable": [self.S11, self.S11_jac]
                        }
         
         if model_type not in self.models:
             raise ValueError(f"Unsupported model type '{model_type}'.")
         
-        self.model_type = model_type.
-        self.model_func = self.models[model_type][0]
-        self.model_eval = self.models[model_type][1]
+        self.model_type = model_type
+        self.model_eval = self.models[model_type][0]
+        self.model_func = self._real_view(self.model_eval)
+        self.model_jac = self.models[model_type][1]
+        self.jac_default = model_type in self.analytic_jac
         self.popt = None
         self.pcov = None
         self.perr = None
 
-    # --- Model Functions ---
-    # -- NOTE ALL functions are duplicated "with suffix c" to 
-    # to handle "model_func" and "model_eval" values
-    # till I figure a neater way to handle this.
-    # 
     @staticmethod
-    def S21c(x, x0, k, amp):
-        val = amp*(1/(1+1j*2*(x-x0)/k))
-        return val
-    
+    def _real_view(model):
+        # wraps keeps the signature, curve_fit counts the parameters from it
+        @functools.wraps(model)
+        def model_func(x, *p):
+            return np.ascontiguousarray(model(x, *p), dtype=complex).view(float)
+        return model_func
+
     @staticmethod
-    def S21(x, x0, k, amp):
-        val = amp*(1/(1+1j*2*(x-x0)/k))
-        return np.concatenate([val.real, val.imag])
+    def _view_data(y):
+        # complex data in the layout of model_func
+        return np.ascontiguousarray(y, dtype=complex).view(float)
+
+    def param_names(self):
+        code = self.model_eval.__code__
+        return list(code.co_varnames[1:code.co_argcount])
 
+    # --- Model Functions ---
+    # All return the complex value (I + 1j*Q)
     @staticmethod
-    def S21sidec(x, x0, ke, k, amp, phi, theta):
-        init_phase = np.exp(-1j*theta)
-        val = amp*(1 - 0.5*ke*np.exp(1j*phi)/(k/2 + 1j*(x-x0)))
-        return init_phase*val
+    def S21(x, x0, k, amp):
+        val = amp*(1/(1+1j*2*(x-x0)/k))
+        return val
 
     @staticmethod
     def S21side(x, x0, ke, k, amp, phi, theta):
         init_phase = np.exp(-1j*theta)
         val = amp*(1 - 0.5*ke*np.exp(1j*phi)/(k/2 + 1j*(x-x0)))
-        
-        val = init_phase*val # replacing
-        return np.concatenate([val.real, val.imag])
-
-    @staticmethod
-    def S21sideFc(x, x0, ke, ki, amp, phi, tau):
-        init_phase = np.exp(-1j*2*np.pi*x*tau)
-        k = ke*np.cos(phi) + ki
-        val = amp*(1 - 0.5*ke*np.exp(1j*phi)/(k/2 + 1j*(x-x0)))
         return init_phase*val
 
     @staticmethod
@@ -76,50 +82,126 @@ class FitterComplex:
         init_phase = np.exp(-1j*2*np.pi*x*tau)
         k = ke*np.cos(phi) + ki
         val = amp*(1 - 0.5*ke*np.exp(1j*phi)/(k/2 + 1j*(x-x0)))
-        val = init_phase*val # replacing
-        return np.concatenate([val.real, val.imag])
+        return init_phase*val
 
-    
     @staticmethod
-    def S21sideCablec(x, x0, ke, k, amp, phi, theta, tau):
+    def S21sideCable(x, x0, ke, k, amp, phi, theta, tau):
         cable_phase = np.exp(1j*(theta - 2*np.pi*x*tau))
         val = amp*(1 - 0.5*ke*np.exp(1j*phi)/(k/2 + 1j*(x-x0)))
         return cable_phase*val
 
     @staticmethod
-    def S21sideCable(x, x0, ke, k, amp, phi, theta, tau):
+    def S21sideCableF(x, x0, ke, ki, amp, phi, theta, tau):
         cable_phase = np.exp(1j*(theta - 2*np.pi*x*tau))
+        k = ke*np.cos(phi) + ki
         val = amp*(1 - 0.5*ke*np.exp(1j*phi)/(k/2 + 1j*(x-x0)))
-        
-        val = cable_phase*val # replacing
-        return np.concatenate([val.real, val.imag])
+        return cable_phase*val
 
     @staticmethod
-    def S21sideCableFc(x, x0, ke, ki, amp, phi, theta, tau):
-        cable_phase = np.exp(1j*(theta - 2*np.pi*x*tau))
+    def S11(x, x0, ke, k, amp):
+        val = amp*(1 - (2*ke/k)/(1+1j*2*(x-x0)/k))
+        return val
+
+    # old names of the complex models
+    S21c = S21
+    S21sidec = S21side
+    S21sideFc = S21sideF
+    S21sideCablec = S21sideCable
+    S21sideCableFc = S21sideCableF
+    S11c = S11
+
+    # --- Jacobians ---
+    # derivatives of the complex model value, in the interleaved
+    # layout of model_func. The (n_params, len(x)) complex array viewed
+    # as floats, transposed is the Fortran ordered Jacobian of MINPACK.
+    # With (K, 1) parameter columns (fit_batch) the result is (K, 2*len(x), n_params).
+    @staticmethod
+    def _stack_jac(dval):
+        return np.moveaxis(np.array(dval, dtype=complex).view(float), 0, -1)
+
+    @staticmethod
+    def _notch(x, x0, ke, k, phi):
+        # g = 0.5*ke*exp(1j*phi)/den of the side coupled models
+        den = k/2 + 1j*(x-x0)
+        return 0.5*ke*np.exp(1j*phi)/den, den
+
+    @staticmethod
+    def S21_jac(x, x0, k, amp):
+        den = k + 2j*(x-x0)
+        val = amp*k/den
+        q = val/den
+        return FitterComplex._stack_jac([2j*q,
+                                         (2j/k)*(x-x0)*q,
+                                         val/amp])
+
+    @staticmethod
+    def S21side_jac(x, x0, ke, k, amp, phi, theta):
+        init_phase = np.exp(-1j*theta)
+        g, den = FitterComplex._notch(x, x0, ke, k, phi)
+        q = (-amp*init_phase)*g/den
+        val = init_phase*(1 - g)
+        return FitterComplex._stack_jac([1j*q,
+                                         (-amp*init_phase/ke)*g,
+                                         -0.5*q,
+                                         val,
+                                         (-1j*amp*init_phase)*g,
+                                         (-1j*amp)*val])
+
+    @staticmethod
+    def S21sideF_jac(x, x0, ke, ki, amp, phi, tau):
+        init_phase = np.exp(-1j*2*np.pi*x*tau)
         k = ke*np.cos(phi) + ki
-        val = amp*(1 - 0.5*ke*np.exp(1j*phi)/(k/2 + 1j*(x-x0)))
-        return cable_phase*val
+        g, den = FitterComplex._notch(x, x0, ke, k, phi)
+        c = -amp*init_phase
+        q = c*g/den
+        val = init_phase*amp*(1 - g)
+        return FitterComplex._stack_jac([1j*q,
+                                         c*g/ke - 0.5*np.cos(phi)*q,
+                                         -0.5*q,
+                                         val/amp,
+                                         1j*c*g + 0.5*ke*np.sin(phi)*q,
+                                         (-1j*2*np.pi)*x*val])
 
     @staticmethod
-    def S21sideCableF(x, x0, ke, ki, amp, phi, theta, tau):
+    def S21sideCable_jac(x, x0, ke, k, amp, phi, theta, tau):
         cable_phase = np.exp(1j*(theta - 2*np.pi*x*tau))
-        k = ke*np.cos(phi) + ki
-        val = amp*(1 - 0.5*ke*np.exp(1j*phi)/(k/2 + 1j*(x-x0)))
-        
-        val = cable_phase*val # replacing
-        return np.concatenate([val.real, val.imag])
-    
+        g, den = FitterComplex._notch(x, x0, ke, k, phi)
+        c = -amp*cable_phase
+        q = c*g/den
+        val = cable_phase*amp*(1 - g)
+        return FitterComplex._stack_jac([1j*q,
+                                         c*g/ke,
+                                         -0.5*q,
+                                         val/amp,
+                                         1j*c*g,
+                                         1j*val,
+                                         (-1j*2*np.pi)*x*val])
+
     @staticmethod
-    def S11c(x, x0, ke, k, amp):
-        val = amp*(1 - (2*ke/k)/(1+1j*2*(x-x0)/k))
-        return val
-    
+    def S21sideCableF_jac(x, x0, ke, ki, amp, phi, theta, tau):
+        cable_phase = np.exp(1j*(theta - 2*np.pi*x*tau))
+        k = ke*np.cos(phi) + ki
+        g, den = FitterComplex._notch(x, x0, ke, k, phi)
+        c = -amp*cable_phase
+        q = c*g/den
+        val = cable_phase*amp*(1 - g)
+        return FitterComplex._stack_jac([1j*q,
+                                         c*g/ke - 0.5*np.cos(phi)*q,
+                                         -0.5*q,
+                                         val/amp,
+                                         1j*c*g + 0.5*ke*np.sin(phi)*q,
+                                         1j*val,
+                                         (-1j*2*np.pi)*x*val])
+
     @staticmethod
-    def S11(x, x0, ke, k, amp):
-        val = amp*(1 - (2*ke/k)/(1+1j*2*(x-x0)/k))
-        return np.concatenate([val.real, val.imag])
-     
+    def S11_jac(x, x0, ke, k, amp):
+        den = k + 2j*(x-x0)
+        g = 2*ke/den
+        q = amp*g/den
+        return FitterComplex._stack_jac([-2j*q,
+                                         (-amp/ke)*g,
+                                         q,
+                                         1 - g])
 
     # --- Initial Guess ---
     # --- CAUTION -> y is in I+1j*Q format
@@ -231,7 +313,8 @@ class FitterComplex:
             dir_name = None,
             file_index = 0,
             auto_guess=True,
-            guess_val = None):
+            guess_val = None,
+            jac = None):
         '''
 
         Parameters
@@ -246,6 +329,9 @@ class FitterComplex:
         auto_guess : True/False
             DESCRIPTION. The default is True.
         guess : list of guess values for fitting
+        jac : True/False, use the analytic Jacobian of the model
+            instead of finite differences. The default None uses it
+            only for the models in FitterComplex.analytic_jac.
         
         You may use:
         
@@ -261,8 +347,11 @@ class FitterComplex:
         else:
             pass
             p0 = guess_val
-        yall = np.concat([y.real, y.imag])
-        self.popt, self.pcov = curve_fit(self.model_func, x, yall, p0=p0)
+        if jac is None:
+            jac = self.jac_default
+        yall = self._view_data(y)
+        self.popt, self.pcov = curve_fit(self.model_func, x, yall, p0=p0,
+                                         jac=self.model_jac if jac else None)
         self.perr = np.sqrt(np.diag(self.pcov))
         
         if save:
@@ -276,6 +365,31 @@ class FitterComplex:
             pass
         return self.popt, self.perr
 
+    def fit_batch(self, x, Y, guess=None, **options):
+        '''
+        Fit every row of the complex Y (K, len(x)) with the batched
+        Levenberg-Marquardt solver (analysis.batch_lm), same as
+        Fitter.fit_batch.
+
+        guess : None (initial_guess of every row), one list used for
+            all rows, or a (K, n_params) array.
+        options : max_iter, xtol, ftol, lam, chunk of batch_lm
+
+        Returns
+        -------
+        popt, perr : (K, n_params)
+        status : (K,), 0 for converged rows (see fit_batch.STATUS)
+
+        self.messages holds the reason for rows whose initial_guess
+        failed (status 2), '' for the other rows.
+        '''
+        x = np.asarray(x, dtype=float)
+        Y = np.atleast_2d(Y)
+        P0, self.messages = start_values(self.initial_guess, x, Y, len(self.param_names()), guess)
+        popt, perr, status, _ = batch_lm(self.model_func, self.model_jac, x,
+                                         self._view_data(Y), P0, **options)
+        return popt, perr, status
+
     def save_plot(self, x, y, dir_name, file_index=0):
         '''
         y data MUST be in I + 1j*Q format
@@ -329,15 +443,13 @@ class FitterComplex:
     def best_fit_params(self):
         if self.popt is None:
             raise RuntimeError("Fit not yet performed.")
-        param_names = self.model_func.__code__.co_varnames[1:self.model_func.__code__.co_argcount]
-        return dict(zip(param_names, self.popt))
+        return dict(zip(self.param_names(), self.popt))
         # return {name: (val, err) for name, val, err in zip(param_names, self.popt, self.perr)}
     
     def best_fit_params_error(self):
         if self.popt is None:
             raise RuntimeError("Fit not yet performed.")
-        param_names = self.model_func.__code__.co_varnames[1:self.model_func.__code__.co_argcount]
-        return dict(zip(param_names, self.perr))
+        return dict(zip(self.param_names(), self.perr))
         # return {name: (val, err) for name, val, err in zip(param_names, self.popt, self.perr)}    
     
     def save_param(self, dir_name = None, file_index=0):
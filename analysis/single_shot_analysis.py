@@ -148,7 +148,7 @@ def analysis_ss(file_path, bins=2**8, g_signal_vals=0, q0_signal_vals=0, cal_ide
 
         plt.tight_layout()
         if save_fig:
-            plt.savefig(rf'{os.path.dirname(file_path)}\\_analysis_ss_{str(i).zfill(3)}.png')
+            plt.savefig(os.path.join(os.path.dirname(file_path), f'_analysis_ss_{str(i).zfill(3)}.png'))
         plt.close()
         # plt.show()
         
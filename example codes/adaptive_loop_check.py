@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+"""
+adaptive_loop must find a narrow peak that sits exactly between
+two of its uniform starting points, where |y| is about the same
+at both ends of the interval and there is no curvature yet.
+
+Lorentzian of width 0.01 at 0.3, 11 starting points on [-1, 1]
+(0.2 and 0.4 are neighbours), 60 points budget.
+
+"""
+
+import numpy as np
+
+from vslab.loop import adaptive_loop
+
+
+def lorentzian(x0=0.3, w=0.01):
+    return lambda x: 1/(1 + ((x - x0)/(w/2))**2)
+
+
+l = adaptive_loop(-1, 1, lorentzian(), points=11, budget=60, name='flux')
+x, y = l.run()
+near = x[np.abs(x - 0.3) <= 0.05]
+print(f'{len(x)} points, {len(near)} within 0.05 of the peak, max |y| {np.max(np.abs(y)):.3f}')
+assert len(near) >= 5
+assert np.max(np.abs(y)) > 0.9
+print('ok')
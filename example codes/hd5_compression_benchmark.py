@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""
+Write speed, read speed and size on disk of SaveHD5 options for a
+typical 1001 x 201 sweep with 6 .dat columns
+(power, freq, r, theta, x, y).
+
+The data are a resonance dip with 1% noise, so the sizes are closer
+to real traces than random numbers would be.
+
+"""
+
+import os
+import tempfile
+from time import perf_counter
+
+import numpy as np
+import xarray as xr
+
+from vslab.fileio import BlockWriter, meta_quick_list
+from vslab.analysis.data import SaveHD5, VerifyChecksums
+
+
+inner_points = 1001
+outer_points = 201
+
+options = {
+    'none': {},
+    'zlib 1': {'compression': 'zlib', 'level': 1},
+    'zlib 4': {'compression': 'zlib', 'level': 4},
+    'zlib 4 shuffle': {'compression': 'zlib', 'level': 4, 'shuffle': True},
+    'zlib 9 shuffle': {'compression': 'zlib', 'level': 9, 'shuffle': True},
+    'lzf': {'compression': 'lzf'},
+    'lzf shuffle': {'compression': 'lzf', 'shuffle': True},
+    'float32': {'dtype': 'float32'},
+    'float32 zlib 4 shuffle': {'dtype': 'float32', 'compression': 'zlib', 'level': 4, 'shuffle': True},
+}
+
+
+tmp = tempfile.mkdtemp()
+freq = np.linspace(4e9, 5e9, inner_points)
+power = np.linspace(-40, 0, outer_points)
+with BlockWriter(os.path.join(tmp, 'sweep.dat')) as wr:
+    for pw in power:
+        s21 = 1 - 0.8/(1 + 2j*(freq - 4.5e9 - 1e5*pw)/1e6)
+        s21 = s21 + 0.01*(np.random.normal(size=inner_points) + 1j*np.random.normal(size=inner_points))
+        wr.write(np.column_stack([np.full(inner_points, pw), freq,
+                                  np.abs(s21), np.angle(s21), s21.real, s21.imag]))
+meta_quick_list([inner_points, freq[0], freq[-1], 'freq'],
+                [outer_points, power[0], power[-1], 'power'], dims=2, ppath=tmp)
+
+dat_size = os.path.getsize(os.path.join(tmp, 'sweep.dat'))
+h5_file = os.path.join(tmp, 'sweep.h5')
+SaveHD5(tmp)  # parses the .dat once, the runs below use the cache
+
+print(f'.dat: {dat_size/2**20:.1f} MB')
+print(f"{'':24} {'write (s)':>10} {'read (s)':>10} {'size (MB)':>10} {'ratio':>7}")
+for label, opts in options.items():
+    t0 = perf_counter()
+    SaveHD5(tmp, **opts)
+    t_write = perf_counter() - t0
+
+    t0 = perf_counter()
+    with xr.open_dataset(h5_file, engine='h5netcdf') as ds:
+        ds.load()
+    t_read = perf_counter() - t0
+
+    size = os.path.getsize(h5_file)
+    print(f'{label:24} {t_write:10.3f} {t_read:10.3f} {size/2**20:10.2f} {dat_size/size:7.1f}')
+
+print(VerifyChecksums(tmp))
+print(f'Files in {tmp}')
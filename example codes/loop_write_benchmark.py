@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+Throughput of the old per-cell writer against the block writer of
+fileio (BlockWriter / _write_block), in rows/s.
+
+Blocks have 6 columns like the ZNB20 power sweep
+(power, freq, r, theta, x, y).
+
+"""
+
+import os
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+from vslab.fileio import BlockWriter
+
+
+row_list = [10**3, 10**4, 10**5, 10**6, 10**7]
+num_cols = 6
+# The per-cell writer needs a few minutes for 1e7 rows,
+# raise this to include it for the largest block.
+legacy_max_rows = 10**6
+
+
+def legacy_write(data, filepath):
+    # loop_write before the block writer
+    fl = open(filepath, 'a+')
+    rows = data.shape[0]
+    cols = data.shape[1]
+    for row in np.arange(rows):
+        for col in np.arange(cols):
+            fl.write(str(data[row][col])+'\t')
+        fl.write('\n')
+    fl.close()
+
+
+def block_write(data, filepath, precision=None):
+    with BlockWriter(filepath, precision=precision) as wr:
+        wr.write(data)
+
+
+def timeit(func, data, filepath, **kwargs):
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    t0 = perf_counter()
+    func(data, filepath, **kwargs)
+    dt = perf_counter() - t0
+    os.remove(filepath)
+    return dt
+
+
+tmp = tempfile.mkdtemp()
+path = os.path.join(tmp, 'bench.dat')
+
+print(f"{'rows':>10} {'legacy rows/s':>15} {'block rows/s':>15} {'block %.10g':>15} {'speedup':>8}")
+for rows in row_list:
+    data = np.random.normal(size=(rows, num_cols))
+
+    t_block = timeit(block_write, data, path)
+    t_prec = timeit(block_write, data, path, precision=10)
+    if rows <= legacy_max_rows:
+        t_legacy = timeit(legacy_write, data, path)
+        legacy = f'{rows/t_legacy:15.3g}'
+        speedup = f'{t_legacy/t_block:8.1f}'
+    else:
+        legacy = f"{'skipped':>15}"
+        speedup = f"{'-':>8}"
+
+    print(f'{rows:10d} {legacy} {rows/t_block:15.3g} {rows/t_prec:15.3g} {speedup}')
+
+os.rmdir(tmp)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+mdata on a synthetic 1000 x 1000 (1e6 rows) qcodes SQLite dataset:
+old export/meta (write_data_to_text_file + three get_parameter_data
+calls per parameter) against fileio._export_dat + fileio._metagen.
+
+"""
+
+import os
+import tempfile
+from time import perf_counter
+
+import numpy as np
+from qcodes import Measurement, Parameter
+from qcodes import initialise_or_create_database_at, load_or_create_experiment
+
+from vslab.fileio import _export_dat, _metagen, _np_unique
+
+
+outer_points = 1000
+inner_points = 1000
+
+
+def legacy_metagen(dataset):
+    # meta part of fileio._metagen before the single-pass version
+    _var = dataset.parameters.split(',')
+    _num_ind = len(_var) - len(dataset.dependent_parameters)
+    _var_ind = _var[:_num_ind]
+    _var_ind.reverse()
+    _lengths, _first_vals, _last_vals = [], [], []
+    for val in _var_ind:
+        _lengths.append(len(_np_unique(dataset.get_parameter_data(val)[val][val])))
+    for val in _var_ind:
+        _first_vals.append(dataset.get_parameter_data(val)[val][val][0])
+    for val in _var_ind:
+        _last_vals.append(dataset.get_parameter_data(val)[val][val][-1])
+    return _lengths, _first_vals, _last_vals
+
+
+tmp = tempfile.mkdtemp()
+initialise_or_create_database_at(os.path.join(tmp, 'bench.db'))
+load_or_create_experiment(experiment_name='bench', sample_name='synthetic')
+
+power = Parameter('power', set_cmd=None, unit='dBm')
+freq = Parameter('freq', set_cmd=None, unit='Hz')
+mag = Parameter('mag', get_cmd=None)
+phase = Parameter('phase', get_cmd=None)
+
+meas = Measurement()
+meas.register_parameter(power)
+meas.register_parameter(freq)
+meas.register_parameter(mag, setpoints=(power, freq))
+meas.register_parameter(phase, setpoints=(power, freq))
+
+freqs = np.linspace(4e9, 5e9, inner_points)
+with meas.run() as datasaver:
+    for pw in np.linspace(-40, 0, outer_points):
+        datasaver.add_result((power, np.full(inner_points, pw)), (freq, freqs),
+                             (mag, np.random.rand(inner_points)),
+                             (phase, np.random.rand(inner_points)))
+dataset = datasaver.dataset
+
+old_dir = os.path.join(tmp, 'old')
+new_dir = os.path.join(tmp, 'new')
+os.makedirs(old_dir)
+os.makedirs(new_dir)
+
+t0 = perf_counter()
+dataset.write_data_to_text_file(old_dir)
+t_old_export = perf_counter() - t0
+
+t0 = perf_counter()
+legacy_metagen(dataset)
+t_old_meta = perf_counter() - t0
+
+t0 = perf_counter()
+_export_dat(dataset, new_dir)
+t_new_export = perf_counter() - t0
+
+t0 = perf_counter()
+_metagen(dataset, new_dir)
+t_new_meta = perf_counter() - t0
+
+print(f'{outer_points*inner_points} rows, {len(dataset.dependent_parameters)} dependent parameters')
+print(f"{'':10} {'old (s)':>10} {'new (s)':>10}")
+print(f"{'export':10} {t_old_export:10.2f} {t_new_export:10.2f}")
+print(f"{'meta':10} {t_old_meta:10.2f} {t_new_meta:10.2f}")
+print(f'Files in {tmp}')
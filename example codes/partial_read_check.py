@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+"""
+Data2D(partial=True) on a sweep stopped after a few outer rows
+must label the rows like the truncated .meta.txt that end_save
+writes for the same file.
+
+A 10-point power sweep from -10 to -30 dBm is stopped after 2 rows.
+
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+os.environ['VSLAB_DATA_ROOT'] = tempfile.mkdtemp()
+
+from vslab import fileio
+from vslab.analysis.data import Data2D
+
+
+freqs = np.linspace(4e9, 5e9, 11)
+powers = np.linspace(-10, -30, 10)
+measured = 2
+
+mydir, _ = fileio.begin_save('partial_check', 'synthetic')
+for pw in powers[:measured]:
+    fileio.loop_write(np.column_stack([np.full(len(freqs), pw), freqs,
+                                       np.random.rand(len(freqs))]), 'power')
+fileio.meta_quick([len(freqs), freqs[0], freqs[-1], 'freq'],
+                  [len(powers), powers[0], powers[-1], 'power'], 2)
+
+live = Data2D(mydir, partial=True, cache=False)
+live.Z(2)
+fileio.end_save()
+done = Data2D(mydir, cache=False)
+done.Z(2)
+
+print('partial  Y', live.Y)
+print('end_save Y', done.Y)
+assert np.allclose(live.Y, done.Y)
+assert np.allclose(sorted(live.Y), sorted(powers[:measured]))
+print('ok')
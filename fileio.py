@@ -6,11 +6,17 @@ Created on Sat Apr 23 15:38:59 2022
 """
 
 import os
+import json
+import time
+import queue
+import atexit
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import errno
 import numpy as np
 from glob import glob
-from pathlib import Path
+from pathlib import Path, PureWindowsPath
 from typing import Sequence, Optional, Any, List
 from shutil import copy, copy2
 import matplotlib.pyplot as plt
@@ -18,6 +24,7 @@ import matplotlib.pyplot as plt
 from qcodes import initialise_or_create_database_at
 from qcodes import load_or_create_experiment
 from qcodes import config
+from qcodes.utils import NumpyJSONEncoder
 
 
 ################################################################################################################
@@ -33,7 +40,10 @@ meta_quick()
 '''
 ###################################
 
-def begin_save(filename='exp_name', device_id = 'sample'):
+def begin_save(filename='exp_name', device_id = 'sample',
+               precision=None, max_rows=10000, max_bytes=2**22,
+               flush_interval=5., backend='dat', compression=None,
+               background=False, queue_size=8, sidecar=False):
     '''
     Parameters
     ----------
@@ -46,57 +56,110 @@ def begin_save(filename='exp_name', device_id = 'sample'):
         DESCRIPTIONS - A name of the sample. 
         The default is 'sample'
 
+    precision, max_rows, max_bytes, flush_interval, backend, compression,
+    background, queue_size, sidecar :
+        Options of the SaveSession opened for this run.
+        backend='h5' or 'both' streams the blocks to .h5 as well.
+        background=True writes on a separate thread (AsyncWriter).
+        sidecar=True also appends the blocks to a binary <name>.bin
+        (SidecarWriter) for fast reloading.
+
     Returns --> None
     Actions:
-    create a date-time directory, and ppath.log to 
-    save the data and script later. 
+    create a date-time directory (with a _2, _3.. suffix if another
+    process already made it) and make it the current run, where
+    the data and script are saved later.
+    Opens a SaveSession, which is used by loop_write and
+    meta_quick till end_save() (or the end of the script).
 
     '''
     filestr =datetime.now().strftime('%Y%m%d_%H%M%S').split('_')
-    mydir = os.path.join('D:\\Data', filestr[0]+'_'+device_id, filestr[1]+'_'+filename)
+    mydir = data_root() / (filestr[0]+'_'+device_id) / (filestr[1]+'_'+filename)
+    mydir = os.path.abspath(_make_run_dir(mydir))
     file2disk = filestr[1]+filename
-    try:
-        os.makedirs(mydir)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise  # This was not a "directory exist" error..
-    
-    with open('ppath.log', 'w') as fl:
-        fl.write(mydir)
+    _run.start(mydir)
+
+    _open_session(SaveSession(mydir, file2disk,
+                              precision=precision,
+                              max_rows=max_rows,
+                              max_bytes=max_bytes,
+                              flush_interval=flush_interval,
+                              backend=backend,
+                              compression=compression,
+                              background=background,
+                              queue_size=queue_size,
+                              sidecar=sidecar))
 
     return mydir, file2disk
 
-def loop_write(data, filename):
+def save_session(filename='exp_name', device_id = 'sample', **kwargs):
+    '''
+    Same as begin_save, but returns the SaveSession so that
+    it can be used as a context manager:
+
+    with save_session(exp_name) as ses:
+        for powe in power_list:
+            ...
+            loop_write(data, exp_name)
+        meta_quick(meta_in, meta_out, 2)
+
+    '''
+    begin_save(filename, device_id, **kwargs)
+    return _session
+
+def end_save():
+    '''
+    Flush and close the SaveSession opened by begin_save.
+    Rewrites the .meta.txt files if meta_quick was called, with
+    the outer loop cut down to the rows written.
+    '''
+    if _session is not None:
+        _session.close()
+
+def loop_write(data, filename, precision=None, sidecar=False):
     '''
     Parameters
     ----------
     data : Numpy data block
     filename: String
+    precision: int or None
+        Number of significant digits. None (default) keeps the
+        full str() representation of every value.
+    sidecar: bool
+        Also append the block to the binary <filename>.bin
+        (SidecarWriter). Inside begin_save, begin_save(...,
+        sidecar=True) switches it on for every filename.
 
     Returns --> None
     Actions:
     writes the data to disk in .dat format using the path 
     specified by ppath and filename.
 
-    FUTURE: Make filename optional and add support for hdf5
+    Use begin_save(..., backend='h5') to stream to hdf5 as well.
+
+    FUTURE: Make filename optional
 
     '''
+    if _session is not None:
+        _session.write(data, filename, precision, sidecar=sidecar)
+        return
     filepath = _read_ppath()
-    fl = open(filepath+'\\'+filename+'.dat','a+')
-    rows = data.shape[0]
-    cols = data.shape[1]
-    for row in np.arange(rows):
-        for col in np.arange(cols):
-            fl.write(str(data[row][col])+'\t')
-        fl.write('\n')
-    fl.close()
-
-def loop_write2(data, filepath):
+    with open(Path(filepath) / (filename+'.dat'),'a+') as fl:
+        _write_block(fl, data, precision)
+    if sidecar:
+        with SidecarWriter(os.path.join(filepath, filename+'.bin')) as wr:
+            wr.write(data)
+        _sidecar_header(os.path.join(filepath, filename+'.bin'),
+                        dat=os.path.join(filepath, filename+'.dat'))
+
+def loop_write2(data, filepath, precision=None):
     '''
     Parameters
     ----------
     data : Numpy data block
     filepath: Full path of the file
+    precision: int or None
+        Number of significant digits, see loop_write.
 
     Returns --> None
     Actions:
@@ -109,12 +172,81 @@ def loop_write2(data, filepath):
         print(f"SERIOUS Warning: '{filepath}' already exists!")
     
     with open(filepath, 'a+') as fl:  # Use 'a+' mode to append data
-        rows, cols = data.shape
-        
-        for row in range(rows):
-            for col in range(cols):
-                fl.write(str(data[row][col]) + '\t')
-            fl.write('\n')
+        _write_block(fl, data, precision)
+
+
+# Number of rows formatted in one go by _write_block.
+# Bounds the size of the temporary string for very large blocks.
+_BLOCK_ROWS = 65536
+
+def _format_block(data, precision=None):
+    '''
+    Format a 2D data block as spyview compatible text in a single
+    string operation (tab after every value, newline after every row).
+    With precision=None the values are written exactly as str() does
+    for the elements of data, i.e. with the shortest repr of their
+    own dtype (np.float32(0.1) as 0.1, not 0.10000000149011612).
+    '''
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data.reshape(1, -1)
+    rows, cols = data.shape
+    if precision is not None:
+        cell, values = f'%.{int(precision)}g', data.ravel().tolist()
+    elif data.dtype.kind == 'f' and data.dtype.itemsize < 8:
+        # tolist() would widen float32/float16 to Python floats
+        cell, values = '%s', data.ravel().astype(str).tolist()
+    else:
+        cell, values = '%r', data.ravel().tolist()
+    line = (cell+'\t')*cols + '\n'
+    return (line*rows) % tuple(values)
+
+def _write_block(fl, data, precision=None):
+    '''
+    Write a data block to an open file handle, _BLOCK_ROWS at a time.
+    '''
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data.reshape(1, -1)
+    for start in range(0, data.shape[0], _BLOCK_ROWS):
+        fl.write(_format_block(data[start:start+_BLOCK_ROWS], precision))
+
+
+class BlockWriter:
+    '''
+    Keeps a .dat file open across the iterations of a measurement
+    loop and writes every data block with a single formatting call.
+
+    Usage:
+
+    with BlockWriter(os.path.join(mydir, exp_name+'.dat')) as wr:
+        for powe in power_list:
+            ...
+            wr.write(data)
+    '''
+    def __init__(self, filepath, precision=None):
+        self.filepath = filepath
+        self.precision = precision
+        self.rows = 0
+        self._fl = open(filepath, 'a+')
+
+    def write(self, data):
+        data = np.asarray(data)
+        _write_block(self._fl, data, self.precision)
+        self.rows += 1 if data.ndim == 1 else data.shape[0]
+
+    def flush(self):
+        self._fl.flush()
+
+    def close(self):
+        if not self._fl.closed:
+            self._fl.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 # Example Usage
 # data = np.array([[1, 2, 3], [4, 5, 6]])
@@ -144,7 +276,7 @@ def meta_quick(meta_in, meta_out, dims):
 
 
     filepath = _read_ppath()
-    _files = glob(filepath+'\\*.dat')
+    _files = glob(os.path.join(filepath, '*.dat'))
     for file in _files:
         with open(file[:-4]+'.meta.txt', 'w+') as metafile:
             metafile.write(_inner_string+_outer_string+_outmost_string)
@@ -153,6 +285,557 @@ def meta_quick(meta_in, meta_out, dims):
 
 
 
+class H5Writer:
+    '''
+    Appends the blocks of a 2D sweep to a chunked .h5 file while
+    the measurement runs, instead of converting the .dat afterwards.
+
+    Every block is one outer loop step in the loop_write layout:
+    column 0 is the outer value, column 1 the inner value and the
+    rest are data columns. The file has the same layout as SaveHD5:
+    coordinates X (inner) and Y (outer), and Z2, Z3, ... of shape
+    (len(Y), len(X)), resized by one chunk-row per block.
+
+    With swmr=True the file can be opened while it is written:
+
+    import h5py
+    f = h5py.File(file_name, 'r', libver='latest', swmr=True)
+    f['Z2'].refresh()
+
+    Parameters
+    ----------
+    filepath : full path of the .h5 file
+    loop_in, loop_out : loop objects, optional
+        Coordinates and names of X and Y. Without them X is taken
+        from column 1 of the first block and Y from column 0.
+    compression, compression_opts : passed to h5py, e.g. 'gzip', 4
+    swmr : single-writer/multiple-reader mode, default True
+    '''
+    def __init__(self, filepath, loop_in=None, loop_out=None,
+                 compression=None, compression_opts=None, swmr=True):
+        import h5py
+        self.filepath = filepath
+        self.loop_in = loop_in
+        self.loop_out = loop_out
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.swmr = swmr
+        self.rows = 0
+        self._outer = None if loop_out is None else list(loop_out)
+        self._fl = h5py.File(filepath, 'w', libver='latest')
+        self._Z = []
+        self._X = None
+        self._Y = None
+        self._meta = None
+
+    def _create(self, data):
+        npts, cols = data.shape
+        if self.loop_in is not None:
+            X = np.asarray(list(self.loop_in), dtype=float)
+            if len(X) != npts:
+                raise ValueError(f'Block has {npts} rows, inner loop has {len(X)} points.')
+        else:
+            X = np.asarray(data[:, 1], dtype=float)
+
+        self._X = self._fl.create_dataset('X', data=X)
+        self._X.make_scale('X')
+        self._Y = self._fl.create_dataset('Y', shape=(0,), maxshape=(None,),
+                                          chunks=(1024,), dtype=float)
+        self._Y.make_scale('Y')
+        for l, ds in ((self.loop_in, self._X), (self.loop_out, self._Y)):
+            if l is not None and getattr(l, 'name', None) is not None:
+                ds.attrs['name'] = str(l.name)
+            if l is not None and getattr(l, 'spacing', None) is not None:
+                ds.attrs['spacing'] = str(l.spacing)
+        if self._outer is not None:
+            self._Y.attrs['npts'] = len(self._outer)
+
+        for col in range(2, cols):
+            Z = self._fl.create_dataset(f'Z{col}', shape=(0, npts), maxshape=(None, npts),
+                                        chunks=(1, npts), dtype=data.dtype,
+                                        compression=self.compression,
+                                        compression_opts=self.compression_opts)
+            Z.dims[0].attach_scale(self._Y)
+            Z.dims[1].attach_scale(self._X)
+            self._Z.append(Z)
+        if self._meta is not None:
+            self._write_attrs()
+
+        if self.swmr:
+            self._fl.swmr_mode = True
+
+    def write(self, data):
+        data = np.asarray(data)
+        if self._X is None:
+            self._create(data)
+        if data.shape[0] != len(self._X):
+            raise ValueError(f'Block has {data.shape[0]} rows, expected {len(self._X)}.')
+
+        k = self.rows
+        if self._outer is not None and k < len(self._outer):
+            y = self._outer[k]
+        else:
+            y = data[0, 0]
+        self._Y.resize((k+1,))
+        self._Y[k] = y
+        for col, Z in enumerate(self._Z, start=2):
+            Z.resize((k+1, Z.shape[1]))
+            Z[k] = data[:, col]
+        self.rows = k+1
+        self.flush()
+
+    def set_meta(self, meta_in, meta_out=None):
+        '''
+        Axis names and npts, first, last of X and Y from the
+        [npts, first, last, name] lists of meta_quick. Attributes
+        can not be added in SWMR mode, there they are written by
+        close().
+        '''
+        self._meta = (meta_in, meta_out)
+        if self._X is not None and not self.swmr:
+            self._write_attrs()
+
+    def _write_attrs(self):
+        for m, ds in zip(self._meta, (self._X, self._Y)):
+            if m is None:
+                continue
+            ds.attrs['name'] = str(m[3])
+            ds.attrs['npts'] = int(m[0])
+            ds.attrs['first'] = float(m[1])
+            ds.attrs['last'] = float(m[2])
+            if len(m) > 4 and 'spacing' not in ds.attrs:
+                # the coordinates are the setpoints from the data
+                ds.attrs['spacing'] = 'non-uniform'
+
+    def flush(self):
+        if self._X is None:
+            return
+        self._Y.flush()
+        for Z in self._Z:
+            Z.flush()
+
+    def close(self):
+        if not self._fl.id:
+            return
+        self._fl.close()
+        if self.swmr and self._meta is not None and self._X is not None:
+            import h5py
+            with h5py.File(self.filepath, 'r+') as fl:
+                self._X, self._Y = fl['X'], fl['Y']
+                self._write_attrs()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_SIDECAR_DTYPE = '<f8'
+
+class SidecarWriter:
+    '''
+    Appends data blocks to <name>.bin as raw little-endian float64,
+    row-major, so that the file is a plain (rows, columns) memmap.
+    A small JSON header <name>.bin.json holds the dtype, the number
+    and names of the columns and, once meta_quick was called, the
+    sweep axes. Read it with analysis.data.read_sidecar.
+
+    with SidecarWriter(os.path.join(mydir, exp_name+'.bin')) as wr:
+        for powe in power_list:
+            ...
+            wr.write(data)
+    '''
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.columns = _sidecar_header(filepath).get('columns')
+        self.fl = open(filepath, 'ab')
+
+    def write(self, data):
+        data = np.ascontiguousarray(data, dtype=_SIDECAR_DTYPE)
+        if data.ndim == 1:
+            data = data.reshape(1, -1)
+        if self.columns is None:
+            self.columns = data.shape[1]
+            _sidecar_header(self.filepath, columns=self.columns)
+        elif data.shape[1] != self.columns:
+            raise ValueError(f'{self.filepath} has {self.columns} columns, got a block with {data.shape[1]}.')
+        self.fl.write(data.tobytes())
+
+    def flush(self):
+        self.fl.flush()
+
+    def close(self):
+        self.fl.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _sidecar_header(filepath, columns=None, meta=None, dat=None):
+    '''
+    Read, and with columns, meta or dat given update, the JSON header
+    of the sidecar filepath (<name>.bin). meta is the
+    (meta_in, meta_out, dims, meta_outmost) of meta_quick, dat the
+    .dat file written along with the sidecar: its size and mtime
+    are recorded, so that readers can check that both match.
+    Returns the header dict ({} if there is none yet).
+    '''
+    header_file = filepath+'.json'
+    header = {}
+    if os.path.exists(header_file):
+        with open(header_file, 'r') as fl:
+            header = json.load(fl)
+    if columns is None and meta is None and dat is None:
+        return header
+
+    header.setdefault('dtype', _SIDECAR_DTYPE)
+    header.setdefault('order', 'C')
+    if columns is not None:
+        header['columns'] = int(columns)
+        header['names'] = [f'Z{i}' for i in range(columns)]
+    if meta is not None:
+        meta_in, meta_out, dims, meta_outmost = meta
+        axes = {'inner': meta_in}
+        if dims >= 2:
+            axes['outer'] = meta_out
+        if dims == 3:
+            axes['outmost'] = meta_outmost
+        header['axes'] = {dim: [int(m[0]), float(m[1]), float(m[2]), str(m[3])]
+                          for dim, m in axes.items()}
+        values = {dim: [float(v) for v in m[4]] for dim, m in axes.items() if len(m) > 4}
+        if values:
+            header['values'] = values
+        names = header.get('names')
+        if dims == 2 and names and len(names) >= 2:
+            # .dat layout of 2D sweeps: outer value, inner value, data
+            names[0], names[1] = str(meta_out[3]), str(meta_in[3])
+    if dat is not None:
+        st = os.stat(dat)
+        header['dat'] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    # replace, so that a reader never sees a half written header
+    with open(header_file+'.tmp', 'w') as fl:
+        json.dump(header, fl)
+    os.replace(header_file+'.tmp', header_file)
+    return header
+
+
+class AsyncWriter:
+    '''
+    Calls a write function on a dedicated thread, so the
+    measurement loop can trigger the next trace while the
+    previous block is formatted and written.
+
+    write() puts the arguments on a bounded queue and blocks
+    when queue_size blocks are waiting (back-pressure).
+    An exception on the writer thread is raised again in the
+    calling thread by the next write(), join() or close().
+
+    Usage:
+
+    wr = BlockWriter(filepath)
+    aw = AsyncWriter(wr.write)
+    for powe in power_list:
+        ...
+        aw.write(data)
+    aw.close()
+    wr.close()
+    '''
+    def __init__(self, write, queue_size=8):
+        self._write = write
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self._error is None:
+                    args, kwargs = item
+                    self._write(*args, **kwargs)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Background write failed.') from error
+
+    def write(self, *args, **kwargs):
+        self._raise()
+        if not self._thread.is_alive():
+            raise RuntimeError('AsyncWriter is closed.')
+        self._queue.put((args, kwargs))
+
+    def join(self):
+        '''
+        Wait till all queued blocks are written.
+        '''
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SaveSession:
+    '''
+    Output directory and open .dat files of one begin_save run.
+
+    loop_write() goes through the session while it is open:
+    rows are formatted and kept in memory, and written to disk
+    once max_rows or max_bytes is reached, every flush_interval
+    seconds, or when the session is closed. Each .dat file is
+    opened only once per run.
+
+    meta_quick() writes the .meta.txt files right away, as outside
+    a session, so the run can be opened while it is still going.
+    close() writes them again with the outer loop cut down to the
+    rows actually written (useful for aborted sweeps).
+
+    backend selects the output: 'dat' (default), 'h5' (one
+    H5Writer per filename, see H5Writer) or 'both'. meta_quick
+    adds the axis names and npts, first, last to X and Y of the .h5.
+
+    With background=True, write() only queues the block and the
+    formatting and disk writes run on an AsyncWriter thread.
+
+    With sidecar=True every block is also appended to <name>.bin
+    (SidecarWriter), and close() adds the sweep axes to its header.
+    '''
+    def __init__(self, path, file2disk=None, precision=None,
+                 max_rows=10000, max_bytes=2**22, flush_interval=5.,
+                 backend='dat', compression=None,
+                 background=False, queue_size=8, sidecar=False):
+        if backend not in ('dat', 'h5', 'both'):
+            raise ValueError(f"Unsupported backend '{backend}'.")
+        self.path = path
+        self.file2disk = file2disk
+        self.precision = precision
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.backend = backend
+        self.compression = compression
+        self.sidecar = sidecar
+        self.rows = {}
+        self.meta = None
+        self.closed = False
+        self._files = {}
+        self._buffers = {}
+        self._buffered_rows = 0
+        self._buffered_bytes = 0
+        self._h5 = {}
+        self._sidecars = {}
+        self._async = AsyncWriter(self._write, queue_size) if background else None
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._timer = None
+        if flush_interval:
+            self._timer = threading.Thread(target=self._flush_loop, daemon=True)
+            self._timer.start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def write(self, data, filename, precision=None, sidecar=False):
+        '''
+        Write a block to filename. sidecar=True also appends it to
+        <filename>.bin, even if the session was opened without
+        sidecar.
+        '''
+        if self._async is not None:
+            if self.closed:
+                raise RuntimeError('SaveSession is closed.')
+            # copy, the caller may reuse its array for the next trace
+            self._async.write(np.array(data), filename, precision, sidecar)
+        else:
+            self._write(data, filename, precision, sidecar)
+
+    def _write(self, data, filename, precision=None, sidecar=False):
+        if precision is None:
+            precision = self.precision
+        data = np.asarray(data)
+        if data.ndim == 1:
+            data = data.reshape(1, -1)
+        with self._lock:
+            if self.closed:
+                raise RuntimeError('SaveSession is closed.')
+            if self.backend != 'dat':
+                if filename not in self._h5:
+                    self._h5[filename] = H5Writer(os.path.join(self.path, filename+'.h5'),
+                                                  compression=self.compression)
+                    # h5py shuts down in its own atexit hook, registered
+                    # on import; close the session before it
+                    atexit.unregister(_close_session)
+                    atexit.register(_close_session)
+                self._h5[filename].write(data)
+            if self.backend != 'h5':
+                self._buffer(data, filename, precision)
+            if self.sidecar or sidecar or filename in self._sidecars:
+                if filename not in self._sidecars:
+                    self._sidecars[filename] = SidecarWriter(os.path.join(self.path, filename+'.bin'))
+                self._sidecars[filename].write(data)
+
+    def _buffer(self, data, filename, precision):
+        text = ''.join(_format_block(data[start:start+_BLOCK_ROWS], precision)
+                       for start in range(0, data.shape[0], _BLOCK_ROWS))
+        with self._lock:
+            if filename not in self._files:
+                self._files[filename] = open(os.path.join(self.path, filename+'.dat'), 'a+')
+                self._buffers[filename] = []
+                self.rows[filename] = 0
+            self._buffers[filename].append(text)
+            self.rows[filename] += data.shape[0]
+            self._buffered_rows += data.shape[0]
+            self._buffered_bytes += len(text)
+            if (self._buffered_rows >= self.max_rows
+                    or self._buffered_bytes >= self.max_bytes):
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self.closed:
+                # the flush timer may still run once after close()
+                return
+            written = []
+            for filename, buf in self._buffers.items():
+                if buf:
+                    fl = self._files[filename]
+                    fl.write(''.join(buf))
+                    fl.flush()
+                    buf.clear()
+                    written.append(filename)
+            for filename, wr in self._sidecars.items():
+                wr.flush()
+                if filename in written:
+                    _sidecar_header(wr.filepath, dat=self._files[filename].name)
+            self._buffered_rows = 0
+            self._buffered_bytes = 0
+
+    def set_meta(self, meta_in, meta_out, dims, meta_outmost=None):
+        '''
+        Record the sweep and write the .meta.txt files of all .dat
+        files written so far. close() writes them again with the
+        outer loop truncated to the rows written.
+        Returns the list of meta files written.
+        '''
+        if self._async is not None:
+            self._async.join()
+        with self._lock:
+            self.meta = (meta_in, meta_out, int(dims), meta_outmost)
+            self.flush()
+            return self._write_meta(truncate=False)
+
+    def _dat_files(self):
+        names = set(glob(os.path.join(self.path, '*.dat')))
+        names.update(os.path.join(self.path, filename+'.dat') for filename in self._files)
+        return sorted(names)
+
+    def _write_meta(self, truncate=True):
+        meta_in, meta_out, dims, meta_outmost = self.meta
+        written = []
+        for file in self._dat_files():
+            filename = os.path.basename(file)[:-4]
+            _meta_out = meta_out
+            if truncate and dims == 2 and filename in self.rows:
+                _meta_out = _truncate_meta(meta_out, self.rows[filename]//int(meta_in[0]))
+            with open(file[:-4]+'.meta.txt', 'w+') as metafile:
+                metafile.write(_meta_string(meta_in, _meta_out, dims, meta_outmost))
+            written.append(file[:-4]+'.meta.txt')
+            if os.path.exists(file[:-4]+'.bin'):
+                _sidecar_header(file[:-4]+'.bin', meta=(meta_in, _meta_out, dims, meta_outmost))
+        for filename, h5 in self._h5.items():
+            _meta_out = meta_out if dims >= 2 else None
+            if truncate and dims == 2:
+                _meta_out = _truncate_meta(meta_out, h5.rows)
+            h5.set_meta(meta_in, _meta_out)
+        return written
+
+    def close(self):
+        global _session
+        error = None
+        if self._async is not None and not self.closed:
+            try:
+                self._async.close()
+            except Exception as e:
+                error = e
+        with self._lock:
+            if self.closed:
+                return
+            self._stop.set()
+            self.flush()
+            if self.meta is not None:
+                self._write_meta()
+            for fl in self._files.values():
+                fl.close()
+            for h5 in self._h5.values():
+                h5.close()
+            for wr in self._sidecars.values():
+                wr.close()
+            self.closed = True
+        if _session is self:
+            _session = None
+        if error is not None:
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# SaveSession opened by begin_save, None outside a run.
+_session = None
+
+def _open_session(session):
+    global _session
+    if _session is not None:
+        _session.close()
+    _session = session
+
+@atexit.register
+def _close_session():
+    if _session is not None:
+        _session.close()
+
+def _truncate_meta(meta_out, npts):
+    '''
+    Outer meta list [n, first, last, name] (or [.., name, values]
+    of a non-uniform loop) for only the first npts points of the
+    outer loop.
+    '''
+    n, first, last = int(meta_out[0]), meta_out[1], meta_out[2]
+    if npts >= n or npts < 1:
+        return meta_out
+    if len(meta_out) > 4:
+        values = list(meta_out[4])[:npts]
+        return [npts, values[0], values[-1], meta_out[3], values]
+    last = first + (npts-1)*(last-first)/(n-1)
+    return [npts, first, last] + list(meta_out[3:])
+
+
+
 #################################################################################################################
 ##  This part of the codes in under testing
 # Attempt to made - meta_quick.py - as universal writer
@@ -163,10 +846,15 @@ def _loop_to_meta(l: Any) -> list:
     """
     Convert a 'loop'-like object to the meta-list format expected by meta_quick_list:
        [n_points (int), first_val, last_val, name_str]
-    Uses l.to_list() if available to avoid re-implementing step/endpoint logic.
+    Uses l.to_array() if available to avoid re-implementing step/endpoint logic.
+    Non-uniform loops (spacing 'log', 'dB', 'center', 'array', adaptive_loop)
+    get the setpoints as a fifth element, written to the .meta.txt as a
+    '#values' line, since n/first/last only describe a linspace.
     """
     # Get iterable values
-    if hasattr(l, "to_list") and callable(getattr(l, "to_list")):
+    if hasattr(l, "to_array") and callable(getattr(l, "to_array")):
+        vals = l.to_array()
+    elif hasattr(l, "to_list") and callable(getattr(l, "to_list")):
         vals = l.to_list()
     else:
         # last resort: exhaust the iterator (works for most iterables)
@@ -178,17 +866,20 @@ def _loop_to_meta(l: Any) -> list:
         first = getattr(l, "start", 0)
         last = getattr(l, "stop", first)
     else:
-        first = vals[0]
-        last = vals[-1]
+        first = float(vals[0])
+        last = float(vals[-1])
 
     name = getattr(l, "name", None)
     # ensure a string for name (original code used 'Nothing' in some places)
     name = str(name) if name is not None else "Nothing"
 
+    if n > 2 and not np.allclose(vals, np.linspace(first, last, n), rtol=1e-9, atol=0):
+        return [n, first, last, name, [float(v) for v in vals]]
     return [n, first, last, name]
 
 
-def meta_quick_list(meta_in: Sequence, meta_out: Optional[Sequence], dims: int = 1, ppath: Optional[str] = None) -> List[str]:
+def meta_quick_list(meta_in: Sequence, meta_out: Optional[Sequence], dims: int = 1, ppath: Optional[str] = None,
+                    meta_outmost: Optional[Sequence] = None) -> List[str]:
     """
     Backwards-compatible implementation of your original meta_quick.
     Parameters
@@ -198,27 +889,24 @@ def meta_quick_list(meta_in: Sequence, meta_out: Optional[Sequence], dims: int =
     meta_out : sequence-like or None
         Same format as meta_in but for the outer loop (only used if dims==2)
     dims : int
-        1 or 2 (the function raises if dims > 2)
+        1, 2 or 3 (the function raises if dims > 3)
     ppath : str or None
         Path to search for .dat files (defaults to cwd or _read_ppath()).
+        Without ppath and with a SaveSession open, the buffered rows
+        are flushed first, and the session writes the files again
+        with the truncated outer loop when it closes.
+    meta_outmost : sequence-like or None
+        Same format as meta_in for the outmost loop (only used if dims==3)
     Returns
     -------
     List[str] -- list of file paths written
     """
     _num_ind = int(dims)
-    if _num_ind not in (1, 2):
-        raise Exception(' Can not create meta file for more than 2 dimensions sweeps')
+    if _num_ind not in (1, 2, 3):
+        raise Exception(' Can not create meta file for more than 3 dimensions sweeps')
 
-    # Build inner string (preserve original ordering / behaviour)
-    _inner_string = '#Inner\n' + str(int(meta_in[0])) + '\n' + str(meta_in[1]) + '\n' + str(meta_in[2]) + '\n' + str(meta_in[3]) + '\n'
-
-    if _num_ind == 1:
-        _outer_string = '#Outer\n1\n0\n1\nNothing\n'
-        _outmost_string = '#Outmost\n1\n0\n1\nNothing\n'
-    else:  # dims == 2
-        # NOTE: preserve original code's ordering for outer (meta_out[2], meta_out[1]) for compatibility
-        _outer_string = '#Outer\n' + str(int(meta_out[0])) + '\n' + str(meta_out[2]) + '\n' + str(meta_out[1]) + '\n' + str(meta_out[3]) + '\n'
-        _outmost_string = '#Outmost\n1\n0\n1\nNothing\n'
+    if ppath is None and _session is not None:
+        return _session.set_meta(meta_in, meta_out, _num_ind, meta_outmost)
 
     if ppath is None:
         filepath = _read_ppath()
@@ -231,13 +919,43 @@ def meta_quick_list(meta_in: Sequence, meta_out: Optional[Sequence], dims: int =
     for file in _files:
         outname = file[:-4] + '.meta.txt'  # strip .dat and append .meta.txt
         with open(outname, 'w+') as metafile:
-            metafile.write(_inner_string + _outer_string + _outmost_string)
-            metafile.write(f'#for each of the values\n{6}\nMeasurement\n')
+            metafile.write(_meta_string(meta_in, meta_out, _num_ind, meta_outmost))
         written_files.append(outname)
+        if os.path.exists(file[:-4]+'.bin'):
+            _sidecar_header(file[:-4]+'.bin', meta=(meta_in, meta_out, _num_ind, meta_outmost))
 
     return written_files
 
 
+def _meta_string(meta_in: Sequence, meta_out: Optional[Sequence], dims: int,
+                 meta_outmost: Optional[Sequence] = None) -> str:
+    """
+    Text of the .meta.txt file for meta_quick_list.
+    """
+    # Build inner string (preserve original ordering / behaviour)
+    _inner_string = '#Inner\n' + str(int(meta_in[0])) + '\n' + str(meta_in[1]) + '\n' + str(meta_in[2]) + '\n' + str(meta_in[3]) + '\n'
+
+    if dims == 1:
+        _outer_string = '#Outer\n1\n0\n1\nNothing\n'
+        _outmost_string = '#Outmost\n1\n0\n1\nNothing\n'
+    else:  # dims == 2 or 3
+        # NOTE: preserve original code's ordering for outer (meta_out[2], meta_out[1]) for compatibility
+        _outer_string = '#Outer\n' + str(int(meta_out[0])) + '\n' + str(meta_out[2]) + '\n' + str(meta_out[1]) + '\n' + str(meta_out[3]) + '\n'
+        _outmost_string = '#Outmost\n1\n0\n1\nNothing\n'
+    if dims == 3:
+        # same ordering as _metagen for the outmost loop
+        _outmost_string = '#Outmost\n' + str(int(meta_outmost[0])) + '\n' + str(meta_outmost[1]) + '\n' + str(meta_outmost[2]) + '\n' + str(meta_outmost[3]) + '\n'
+
+    # setpoints of non-uniform loops, in measurement order
+    _values_string = ''
+    for dim, m in zip(('inner', 'outer', 'outmost'), (meta_in, meta_out, meta_outmost)[:dims]):
+        if m is not None and len(m) > 4:
+            _values_string += f'#values {dim} ' + ' '.join(repr(float(v)) for v in m[4]) + '\n'
+
+    return (_inner_string + _outer_string + _outmost_string
+            + f'#for each of the values\n{6}\nMeasurement\n' + _values_string)
+
+
 def meta_quick_loop(loop_in: Any, loop_out: Optional[Any] = None, dims: Optional[int] = None, ppath: Optional[str] = None) -> List[str]:
     """
     Create meta files from loop-like objects. Converts loops to meta-lists and calls meta_quick_list.
@@ -255,17 +973,36 @@ def meta_quick_loop(loop_in: Any, loop_out: Optional[Any] = None, dims: Optional
     return meta_quick_list(meta_in, meta_out, dims=_dims, ppath=ppath)
 
 
+def meta_quick_sweep(sweep: Any, ppath: Optional[str] = None) -> List[str]:
+    """
+    Create meta files for a loop.SweepND of 1 to 3 loops.
+    With snake=True the meta still describes the raster grid,
+    reorder the data with sweep.order() before loading it as a grid.
+    """
+    metas = [_loop_to_meta(l) for l in reversed(sweep.loops)]  # innermost first
+    if len(metas) > 3:
+        raise Exception(' Can not create meta file for more than 3 dimensions sweeps')
+    metas += [None]*(3-len(metas))
+    return meta_quick_list(metas[0], metas[1], dims=len(sweep.loops), ppath=ppath,
+                           meta_outmost=metas[2])
+
+
 def meta_quick(*args, dims: Optional[int] = None, ppath: Optional[str] = None) -> List[str]:
     """
     Dispatcher function:
       - meta_quick(meta_in_list, meta_out_list, dims)  -> calls meta_quick_list
       - meta_quick(loop_in, loop_out)                 -> calls meta_quick_loop
+      - meta_quick(sweep)                             -> calls meta_quick_sweep
     Returns list of written file paths.
 
     Examples:
       meta_quick([10, 0, 9, 'X'], [5, 0, 4, 'Y'], 2)
       meta_quick(loop1, loop2)
+      meta_quick(SweepND(loop_outmost, loop_out, loop_in))
     """
+    if len(args) == 1 and hasattr(args[0], 'loops'):
+        return meta_quick_sweep(args[0], ppath=ppath)
+
     # Two args -> treat as loop objects if they look like loops
     if len(args) == 2:
         a, b = args
@@ -323,6 +1060,17 @@ def _np_unique(array):
     return [array[index] for index in sorted(_indices)]
 
 
+def _num_unique(array):
+    '''
+    Number of unique values in an array, from one sort
+    (no list of the values like _np_unique).
+    '''
+    array = np.ravel(array)
+    if len(array) == 0:
+        return 0
+    return int(np.count_nonzero(np.diff(np.sort(array)))) + 1
+
+
 def mstart(sample_name, exp_name):
     '''
     
@@ -338,8 +1086,8 @@ def mstart(sample_name, exp_name):
     Actions:
         1: initialize_or_create_experiment. It happens everytime.
         2: initialize_or_create_database. It happends once everyday
-        3: Config the database to "D:\\database\\"
-        4. Save the PPATH info in a temporary file 'ppath.log'
+        3: Config the database to database_root() (D:\\database by default)
+        4. Make PPATH the current run (ppath.log is kept as a fallback)
     -------
     '''
     # setting the experiemnt
@@ -347,9 +1095,11 @@ def mstart(sample_name, exp_name):
     _date_time = datetime.now()
     _d = _date_time.strftime("%Y%m%d")
     _t = _date_time.strftime("%H%M%S")
-    ppath = 'D:\\data\\'+_d+'\\'+_t
+    ppath = str(data_root() / _d / _t)
     
-    initialise_or_create_database_at('D:\\database\\'+_d+'_'+sample_name+'.db')
+    db_root = database_root()
+    db_root.mkdir(parents=True, exist_ok=True)
+    initialise_or_create_database_at(str(db_root / (_d+'_'+sample_name+'.db')))
     config.add("base_location",ppath,
         value_type="string", 
         description="Location of data", 
@@ -359,16 +1109,19 @@ def mstart(sample_name, exp_name):
     exp = load_or_create_experiment(experiment_name=exp_name,
                                 sample_name=sample_name)
     
-    with open('ppath.log', 'w') as fl:
-        fl.write(ppath_tag)
+    _run.start(_make_run_dir(ppath_tag))
     pass
 
-def mdata(dataset):
+def mdata(dataset, fmt='dat', compression=None):
     '''
     Parameters
     ----------
     dataset : "datasaver.dataset"
         First input should be a "dataset"
+    fmt : 'dat' (default), 'h5' or 'both'
+        'h5' exports straight to a gridded <run>.h5 (see _export_h5)
+        without the ASCII files, 'both' writes both.
+    compression : h5py compression of the .h5, e.g. 'gzip'
     
     Returns --> None.
     Actions: 
@@ -376,29 +1129,39 @@ def mdata(dataset):
         2: create *.meta
     
     '''
+    if fmt not in ('dat', 'h5', 'both'):
+        raise ValueError(f"Unsupported format '{fmt}'.")
     _create_dir_from_ppath()
     
     ppath_tag = _read_ppath()
+    if fmt != 'dat':
+        _export_h5(dataset, ppath_tag, compression=compression)
+    if fmt == 'h5':
+        return
     # converting from database to ASCII
-    dataset.write_data_to_text_file(ppath_tag)
+    _export_dat(dataset, ppath_tag)
     # Renaming with DATE/Time stamp etc
     _rename_files(ppath_tag, '.dat')
     # creating metagen
     _metagen(dataset, ppath_tag)
     pass
 
-def mcopy(script2copy):
+def mcopy(script2copy, snapshot=True):
     '''
     Parameters
     ----------
     script2copy : __file__
         DESCRIPTION --> use the __file__  magic dunder to give the full 
         path of the measurement script.
+    snapshot : True/False
+        Also save the settings of all open qcodes instruments
+        with msnapshot(). The default is True.
 
     Returns --> None
     Actions:
         1: read the ppath info from *.log
         2: copy the measurement script to date/time folder
+        3: msnapshot(), if any instrument is open
     -------
 
     '''
@@ -407,15 +1170,97 @@ def mcopy(script2copy):
     copy2(script2copy, ppath_tag)
     # renaming to give unique time and experiment stamp
     _rename_files(ppath_tag, '.py')
-    pass
+    if snapshot and _open_instruments():
+        msnapshot()
 
 
 
 
+class RunContext:
+    '''
+    Output directory of the run started by begin_save or mstart
+    in this process. loop_write, meta_quick, mdata and mcopy take
+    the path from here, so two scripts running at the same time
+    do not see each other's directory and a change of the CWD
+    does not matter.
+
+    ppath.log is still written to the CWD, and only read when no
+    run was started in this process (e.g. mcopy from a script
+    that did not call mstart).
+    '''
+    def __init__(self):
+        self.path = None
+
+    def start(self, path):
+        self.path = os.path.abspath(path)
+        with open('ppath.log', 'w') as fl:
+            fl.write(self.path)
+
+    def read(self):
+        if self.path is not None:
+            return self.path
+        with open('ppath.log','r+') as fl:
+            return fl.read()
+
+_run = RunContext()
+
+def current_run():
+    '''
+    Directory of the current run (None before begin_save/mstart).
+    '''
+    return _run.path
+
+def _make_run_dir(path):
+    '''
+    Create path, or path_2, path_3.. if it already exists, so that
+    measurements started in the same second by different processes
+    get their own directory. Returns the created directory.
+    '''
+    candidate, n = path, 1
+    while True:
+        try:
+            os.makedirs(candidate)
+            return candidate
+        except FileExistsError:
+            n += 1
+            candidate = f'{path}_{n}'
+
 def _read_ppath():
-    with open('ppath.log','r+') as fl:
-        ppath_tag = fl.read()
-    return ppath_tag
+    return _run.read()
+
+_DEFAULT_ROOTS = {'data_root': 'D:\\Data', 'database_root': 'D:\\database'}
+
+def _root(key):
+    '''
+    VSLAB_DATA_ROOT / VSLAB_DATABASE_ROOT if set, else the key in the
+    json file VSLAB_CONFIG (default ~/.vslab.json), else D:\\Data and
+    D:\\database on Windows and ~/Data, ~/database elsewhere.
+    '''
+    value = os.environ.get('VSLAB_'+key.upper())
+    if not value:
+        config_file = Path(os.environ.get('VSLAB_CONFIG', Path.home() / '.vslab.json'))
+        if config_file.is_file():
+            with open(config_file, 'r') as fl:
+                value = json.load(fl).get(key)
+    if not value:
+        if os.name == 'nt':
+            value = _DEFAULT_ROOTS[key]
+        else:
+            value = Path.home() / PureWindowsPath(_DEFAULT_ROOTS[key]).name
+    return Path(value).expanduser()
+
+def data_root():
+    '''
+    Top directory of the measurement folders made by begin_save
+    and mstart (see _root for how it is configured).
+    '''
+    return _root('data_root')
+
+def database_root():
+    '''
+    Directory of the qcodes databases made by mstart.
+    '''
+    return _root('database_root')
     
 def _create_dir_from_ppath():
     ppath_tag = _read_ppath()
@@ -423,12 +1268,135 @@ def _create_dir_from_ppath():
     pass
 
 def _rename_files(ppath_tag, extn):
-    _files = glob(ppath_tag+'\\*'+extn)
-    _last_dir = ppath_tag.split('\\')[-1]
-    for file in _files:
-        _new_name = ppath_tag+'\\'+_last_dir+'_'+file.split('\\')[-1]
-        os.rename(file, _new_name)
+    ppath_tag = Path(ppath_tag)
+    for file in list(ppath_tag.glob('*'+extn)):
+        file.rename(ppath_tag / (ppath_tag.name+'_'+file.name))
+
+
 
+def _export_dat(dataset, ppath_tag):
+    '''
+    Same files as dataset.write_data_to_text_file(ppath_tag):
+    one <parameter>.dat per dependent parameter with the setpoint
+    columns followed by the value. Each parameter is read from the
+    database once and written block-wise with _write_block,
+    without building pandas dataframes.
+    '''
+    for dep in dataset.dependent_parameters:
+        name = dep.name
+        _data = dataset.get_parameter_data(name)[name]
+        setpoints = dataset.paramspecs[name].depends_on_
+        columns = [np.ravel(_data[sp]) for sp in setpoints] + [np.ravel(_data[name])]
+        with open(os.path.join(ppath_tag, name+'.dat'), 'w') as fl:
+            for start in range(0, len(columns[-1]), _BLOCK_ROWS):
+                block = np.column_stack([c[start:start+_BLOCK_ROWS] for c in columns])
+                _write_block(fl, block)
+
+
+def _independent_values(dataset, names):
+    '''
+    Values of the independent parameters (one query for all),
+    in the form used by _metagen: the first array of an 'array'
+    parameter, all values of a 'numeric' one.
+    '''
+    _data = dataset.get_parameter_data(*names)
+    values = []
+    for val in names:
+        if dataset.paramspecs[val].type == 'array':
+            values.append(_data[val][val][0])
+        elif dataset.paramspecs[val].type == 'numeric':
+            values.append(_data[val][val])
+        else:
+            raise Exception('Unable to determine the value type')
+    return values
+
+
+def _export_h5(dataset, ppath_tag, compression=None, compression_opts=None):
+    '''
+    Export a qcodes dataset to <run>.h5 in ppath_tag, gridded as
+    (outmost, outer, inner) with the independent parameters as
+    labelled coordinates (netCDF dimension scales, readable by
+    xr.open_dataset(file, engine='h5netcdf')).
+
+    The dependent parameters are read from the database in slices
+    of results, so memory stays bounded. The sweep is assumed to be
+    a regular grid filled in order; missing points stay NaN.
+    '''
+    import h5py
+    _var = dataset.parameters.split(',')
+    _num_ind = len(_var) - len(dataset.dependent_parameters)
+    _var_ind = _var[:_num_ind]
+    _var_ind.reverse()  # inner first, as in _metagen
+    if _num_ind > 3:
+        raise Exception(' Can not create meta file for more than 3 dimensions sweeps')
+
+    coords = []
+    for _vals in _independent_values(dataset, _var_ind):
+        _vals = np.ravel(_vals)
+        coords.append(_vals[np.sort(np.unique(_vals, return_index=True)[1])])
+    names = _var_ind[::-1]
+    coords = coords[::-1]  # outmost ... inner, the order of the rows
+    shape = tuple(len(c) for c in coords)
+
+    file_name = os.path.join(ppath_tag, os.path.basename(os.path.normpath(ppath_tag))+'.h5')
+    with h5py.File(file_name, 'w') as fl:
+        scales = []
+        for name, c in zip(names, coords):
+            ds = fl.create_dataset(name, data=c)
+            ds.make_scale(name)
+            ds.attrs['units'] = dataset.paramspecs[name].unit
+            ds.attrs['long_name'] = dataset.paramspecs[name].label or name
+            scales.append(ds)
+
+        total = dataset.number_of_results
+        for dep in dataset.dependent_parameters:
+            name = dep.name
+            Z = fl.create_dataset(name, shape=shape, dtype=float, fillvalue=np.nan,
+                                  chunks=(1,)*(len(shape)-1) + (shape[-1],),
+                                  compression=compression,
+                                  compression_opts=compression_opts)
+            for i, ds in enumerate(scales):
+                Z.dims[i].attach_scale(ds)
+            Z.attrs['units'] = dataset.paramspecs[name].unit
+            Z.attrs['long_name'] = dataset.paramspecs[name].label or name
+
+            # about _BLOCK_ROWS values per query, also for array valued results
+            per_result = np.size(dataset.get_parameter_data(name, start=1, end=1)[name][name])
+            step = max(1, _BLOCK_ROWS // max(1, per_result))
+            flat = 0
+            pending = np.zeros(0)
+            start = 1
+            while start <= total:
+                end = min(start+step-1, total)
+                _vals = np.ravel(dataset.get_parameter_data(name, start=start, end=end)[name][name])
+                pending = np.concatenate([pending, _vals])
+                flat, pending = _write_grid(Z, flat, pending)
+                start = end+1
+            if pending.size:
+                _write_grid(Z, flat, np.concatenate([pending, np.full(shape[-1]-pending.size, np.nan)]))
+    return file_name
+
+
+def _write_grid(Z, flat, values):
+    '''
+    Write the complete inner rows of values into the gridded
+    dataset Z, starting at inner-row number flat.
+    Returns the next row number and the values left over.
+    '''
+    inner = Z.shape[-1]
+    nrows = min(values.size // inner, int(np.prod(Z.shape[:-1])) - flat)
+    rows = values[:nrows*inner].reshape(nrows, inner)
+    if Z.ndim == 1:
+        if nrows:
+            Z[:] = rows[0]
+    else:
+        done = 0
+        while done < nrows:
+            idx = np.unravel_index(flat+done, Z.shape[:-1])
+            count = min(nrows-done, Z.shape[-2]-idx[-1])
+            Z[tuple(idx[:-1]) + (slice(idx[-1], idx[-1]+count),)] = rows[done:done+count]
+            done += count
+    return flat+nrows, values[nrows*inner:]
 
 
 def _metagen(dataset, ppath_tag):
@@ -447,34 +1415,12 @@ def _metagen(dataset, ppath_tag):
     _var_dep = _var[_num_ind:]
 # Getting all information from the datset
     _lengths = []
-    for val in _var_ind:
-        if dataset.paramspecs[val].type == 'array':
-            _len = int(len(_np_unique(dataset.get_parameter_data(val)[val][val][0])))
-        elif dataset.paramspecs[val].type == 'numeric':
-            _len = int(len(_np_unique(dataset.get_parameter_data(val)[val][val])))
-        else:
-            raise Exception('Unable to determine the value type')
-        _lengths = np.append(_lengths, _len)
     _first_vals = []
-    for val in _var_ind:
-        if dataset.paramspecs[val].type == 'array':
-            _val_first = dataset.get_parameter_data(val)[val][val][0][0]
-        elif dataset.paramspecs[val].type == 'numeric':
-            _val_first = dataset.get_parameter_data(val)[val][val][0]
-        else:
-            raise Exception('Unable to determine the value type')
-            
-        _first_vals = np.append(_first_vals, _val_first)
-    
     _last_vals = []
-    for val in _var_ind:
-        if dataset.paramspecs[val].type == 'array':
-            _val_last = dataset.get_parameter_data(val)[val][val][0][-1]
-        elif dataset.paramspecs[val].type == 'numeric':
-            _val_last = dataset.get_parameter_data(val)[val][val][-1]
-        else:
-            raise Exception('Unable to determine the value type')
-        _last_vals = np.append(_last_vals, _val_last)
+    for val, _vals in zip(_var_ind, _independent_values(dataset, _var_ind)):
+        _lengths = np.append(_lengths, _num_unique(_vals))
+        _first_vals = np.append(_first_vals, _vals[0])
+        _last_vals = np.append(_last_vals, _vals[-1])
 #  Structure of the various strings in the meta file
     _inner_string = '#Inner\n'+str(int(_lengths[0]))+'\n'+str(_first_vals[0])+'\n'+str(_last_vals[0])+'\n'+_var_ind[0]+'\n'
     if _num_ind == 1:
@@ -489,7 +1435,7 @@ def _metagen(dataset, ppath_tag):
     else:
         raise Exception(' Can not create meta file for more than 3 dimensions sweeps')
     # Reading att the *.dat files and create .meta.txt for each.
-    _files = glob(ppath_tag+'\\*.dat')
+    _files = glob(os.path.join(ppath_tag, '*.dat'))
     for file in _files:
         with open(file[:-4]+'.meta.txt', 'w+') as metafile:
             metafile.write(_inner_string+_outer_string+_outmost_string)
@@ -504,4 +1450,65 @@ def _metagen(dataset, ppath_tag):
 from qcodes.instrument.base import Instrument
 
 def close_all_instruments():
-    Instrument.close_all()
\ No newline at end of file
+    Instrument.close_all()
+
+# name -> time of the last full (update=True) snapshot in this session
+_snapshot_times = {}
+
+def _open_instruments():
+    instruments = []
+    for ins in list(Instrument._all_instruments.values()):
+        if isinstance(ins, weakref.ref):  # older qcodes keeps weakrefs
+            ins = ins()
+        if ins is not None:
+            instruments.append(ins)
+    return instruments
+
+def _snapshot_one(ins, max_age):
+    # re-query the instrument only if the last full snapshot is too old,
+    # otherwise qcodes returns the cached (last set/get) parameter values
+    last = _snapshot_times.get(ins.name)
+    update = last is None or max_age is None or time.time() - last > max_age
+    snap = ins.snapshot(update=update)
+    if update:
+        _snapshot_times[ins.name] = time.time()
+    return snap
+
+def msnapshot(max_age=3600., filename='snapshot'):
+    '''
+    Parameters
+    ----------
+    max_age : seconds, or None
+        An instrument is queried again only if its last full
+        snapshot in this python session is older than max_age.
+        None always queries all parameters.
+    filename : String, without extension
+
+    Returns --> path of the json file
+    Actions:
+        1: read the ppath info from *.log
+        2: snapshot() of every open qcodes instrument, one
+           thread per instrument to overlap the VISA round trips
+        3: write them as compact json to the date/time folder
+    -------
+
+    '''
+    ppath_tag = _read_ppath()
+    _create_dir_from_ppath()
+    instruments = _open_instruments()
+
+    snapshot = {}
+    if instruments:
+        with ThreadPoolExecutor(max_workers=len(instruments)) as pool:
+            futures = {ins.name: pool.submit(_snapshot_one, ins, max_age) for ins in instruments}
+        for name, future in futures.items():
+            try:
+                snapshot[name] = future.result()
+            except Exception as e:
+                snapshot[name] = {'error': repr(e)}
+
+    file_name = os.path.join(ppath_tag, filename+'.json')
+    with open(file_name, 'w') as fl:
+        json.dump({'time': datetime.now().isoformat(), 'instruments': snapshot},
+                  fl, cls=NumpyJSONEncoder, separators=(',', ':'))
+    return file_name
@@ -1,11 +1,19 @@
 # loop.py
 from typing import Optional, Iterator
 import math
+import numpy as np
 
 class loop:
     """
     Iterable that yields values from start -> stop.
 
+    Values are computed as start + index*step in one vectorized
+    call (no accumulated float drift) and cached, so indexing,
+    slicing, len() and to_array() are O(1) after the first use.
+
+    Non-linear sweeps use `points` with a `spacing` other than
+    'linear', or loop.from_array(values) for an explicit list.
+
     Parameters
     ----------
     start : number
@@ -22,8 +30,23 @@ class loop:
         Whether to include `stop` (when using `incr`) or behave like linspace's endpoint.
     tol : float, default 1e-12
         Tolerance for floating point comparisons.
+    spacing : str, default 'linear'
+        'linear' : equal steps.
+        'log'    : geometric steps (np.geomspace), start and stop
+                   must be non-zero with the same sign.
+        'dB'     : start/stop in dB(m), points equally spaced in
+                   linear power and returned in dB(m).
+        'center' : dense around `center`, sparse towards start
+                   and stop; `density` > 1 sets how dense.
+        All but 'linear' need `points`.
+    center : number, optional
+        Center of the 'center' spacing. Default (start+stop)/2.
+    density : float, default 3.0
+        Exponent of the 'center' spacing (1 is linear).
     """
 
+    _spacings = ('linear', 'log', 'dB', 'center', 'array')
+
     def __init__(self,
                  start: float,
                  stop: float,
@@ -31,7 +54,10 @@ class loop:
                  incr: Optional[float] = None,
                  name: Optional[str] = None,
                  inclusive: bool = True,
-                 tol: float = 1e-12):
+                 tol: float = 1e-12,
+                 spacing: str = 'linear',
+                 center: Optional[float] = None,
+                 density: float = 3.0):
         self.start = float(start)
         self.stop = float(stop)
         self.points = None if points is None else int(points)
@@ -39,7 +65,18 @@ class loop:
         self.name = name
         self.inclusive = bool(inclusive)
         self.tol = float(tol)
-
+        self.spacing = spacing
+        self.center = (self.start + self.stop) / 2 if center is None else float(center)
+        self.density = float(density)
+
+        if spacing not in self._spacings:
+            raise ValueError(f"Unsupported spacing '{spacing}'. Use one of {self._spacings[:-1]}.")
+        if spacing != 'linear' and self.points is None:
+            raise ValueError(f"spacing '{spacing}' needs points")
+        if spacing == 'log' and (self.start == 0 or self.stop == 0 or (self.start > 0) != (self.stop > 0)):
+            raise ValueError("log spacing needs non-zero start and stop of the same sign")
+        if spacing == 'center' and not min(self.start, self.stop) <= self.center <= max(self.start, self.stop):
+            raise ValueError("center must lie between start and stop")
         if self.points is not None and self.points < 1:
             raise ValueError("points must be >= 1")
         if self.incr is not None and self.incr == 0:
@@ -47,97 +84,371 @@ class loop:
         # points takes precedence over incr if both provided
         if self.points is not None and self.incr is not None:
             self.incr = None
-
-    def __iter__(self) -> Iterator[float]:
-        """Return a fresh iterator (generator) so the object is re-iterable."""
+        self._cache = None
+        self._values = None
+
+    @classmethod
+    def from_array(cls, values, name: Optional[str] = None) -> "loop":
+        """loop over an explicit list/array of setpoints."""
+        values = np.array(values, dtype=float).ravel()
+        if len(values) == 0:
+            raise ValueError("values must not be empty")
+        l = cls(values[0], values[-1], points=len(values), name=name)
+        l.spacing = 'array'
+        l._values = values
+        return l
+
+    def _key(self):
+        return (self.start, self.stop, self.points, self.incr, self.inclusive, self.tol,
+                self.spacing, self.center, self.density)
+
+    @property
+    def step(self) -> float:
+        """Distance between consecutive values (average step if not 'linear')."""
+        if self.points is not None:
+            denom = self.points - 1 if self.inclusive else self.points
+            return (self.stop - self.start) / denom if denom > 0 else 0.0
+        if self.incr is not None:
+            return self.incr
+        # sensible default step
+        return 1.0 if self.start <= self.stop else -1.0
+
+    def _count(self) -> int:
         if self.points is not None:
-            return self._iter_points()
-        return self._iter_incr()
-
-    def _iter_points(self) -> Iterator[float]:
-        # behave like numpy.linspace with endpoint==inclusive
-        n = self.points
-        if n == 1:
-            yield self.start
-            return
+            return self.points
+
+        step = self.step
+        # if step moves the wrong direction -> 0
+        if (self.start < self.stop and step <= 0) or (self.start > self.stop and step >= 0):
+            return 0
+
+        span = abs(self.stop - self.start)
         if self.inclusive:
-            denom = n - 1
-        else:
-            denom = n
-        step = (self.stop - self.start) / denom if denom != 0 else 0.0
-        for i in range(n):
-            yield self.start + i * step
-
-    def _iter_incr(self) -> Iterator[float]:
-        step = self.incr
-        if step is None:
-            # sensible default step
-            step = 1.0 if self.start <= self.stop else -1.0
-
-        cur = self.start
-
-        # comparison lambdas with tolerance
-        if step > 0:
-            if self.inclusive:
-                cmp = lambda a, b: a <= b + self.tol
+            # all i with i*|step| <= span + tol
+            return int(math.floor((span + self.tol) / abs(step))) + 1
+        # all i with i*|step| < span - tol
+        return max(0, int(math.ceil((span - self.tol) / abs(step))))
+
+    def to_array(self) -> np.ndarray:
+        """Return all values as a (read-only, cached) numpy array."""
+        if self._cache is None or self._cache[0] != self._key():
+            n = self._count()
+            if self.spacing != 'linear':
+                values = self._nonlinear(n)
+            elif self.points is not None:
+                values = np.linspace(self.start, self.stop, n, endpoint=self.inclusive)
             else:
-                cmp = lambda a, b: a < b - self.tol
-            while cmp(cur, self.stop):
-                yield cur
-                cur += step
-        else:
-            if self.inclusive:
-                cmp = lambda a, b: a >= b - self.tol
-            else:
-                cmp = lambda a, b: a > b + self.tol
-            while cmp(cur, self.stop):
-                yield cur
-                cur += step
+                values = self.start + np.arange(n) * self.step
+            values.flags.writeable = False
+            self._cache = (self._key(), values)
+        return self._cache[1]
+
+    def _nonlinear(self, n) -> np.ndarray:
+        if self.spacing == 'array':
+            return self._values.copy()
+        if self.spacing == 'log':
+            return np.geomspace(self.start, self.stop, n, endpoint=self.inclusive)
+        if self.spacing == 'dB':
+            power = np.linspace(10**(self.start/10), 10**(self.stop/10), n, endpoint=self.inclusive)
+            values = 10*np.log10(power)
+            values[0] = self.start
+            if self.inclusive and n > 1:
+                values[-1] = self.stop
+            return values
+        # 'center'
+        u = np.linspace(-1, 1, n, endpoint=self.inclusive) if n > 1 else np.array([-1.0])
+        d = np.sign(u) * np.abs(u)**self.density
+        return self.center + np.where(u < 0, self.center - self.start, self.stop - self.center) * d
+
+    def __iter__(self) -> Iterator[float]:
+        """Return a fresh iterator so the object is re-iterable."""
+        return iter(self.to_array().tolist())
+
+    def __reversed__(self) -> Iterator[float]:
+        return iter(self.to_array()[::-1].tolist())
+
+    def __getitem__(self, index):
+        """
+        loop[i] -> float, loop[i:j:k] -> numpy array.
+        """
+        values = self.to_array()
+        if isinstance(index, slice):
+            return values[index]
+        return float(values[index])
 
     def to_list(self):
         """Return all values as a list."""
-        return list(iter(self))
+        return self.to_array().tolist()
+
+    def reverse(self) -> "loop":
+        """Same values in the opposite order, as a new loop."""
+        values = self.to_array()
+        if len(values) == 0:
+            return loop(self.stop, self.start, incr=-self.step, name=self.name,
+                        inclusive=self.inclusive, tol=self.tol)
+        if self.spacing != 'linear':
+            return loop.from_array(values[::-1], name=self.name)
+        return loop(values[-1], values[0], points=len(values), name=self.name)
+
+    def chunks(self, size: int) -> Iterator[np.ndarray]:
+        """Yield the values in consecutive arrays of at most size points."""
+        if size < 1:
+            raise ValueError("size must be >= 1")
+        values = self.to_array()
+        for i in range(0, len(values), size):
+            yield values[i:i+size]
 
     def __len__(self):
-        """Return length when possible:
+        """Return length:
            - if points specified -> points
-           - if incr specified -> compute approximate count
-           - otherwise compute using default incr (1 or -1)
+           - if incr specified -> number of values start + i*incr up to stop
+           - otherwise the same using default incr (1 or -1)
         """
-        if self.points is not None:
-            return self.points
-
-        step = self.incr
-        if step is None:
-            step = 1.0 if self.start <= self.stop else -1.0
-
-        # if step moves the wrong direction -> 0
-        if (self.start < self.stop and step <= 0) or (self.start > self.stop and step >= 0):
-            return 0
-
-        # compute number of steps (floor-based) and adjust for inclusive
-        span = self.stop - self.start
-        raw = span / step
-        if raw < -self.tol:
-            return 0
-        # floor towards zero depending on sign of step
-        n = int(math.floor(raw + self.tol)) + 1
-        if self.inclusive:
-            # if last point aligns closely with stop but raw was slightly smaller,
-            # ensure we include the stop
-            if math.isclose(self.start + (n - 1) * step, self.stop, rel_tol=0, abs_tol=self.tol):
-                return n
-            # else if exact stop isn't hit but would fit because of floating error, allow it
-        return max(0, n)
+        return len(self.to_array())
 
     def __repr__(self):
         name = f" name='{self.name}'" if self.name is not None else ""
+        if self.spacing != 'linear':
+            return f"loop(start={self.start}, stop={self.stop}, points={self.points}, spacing='{self.spacing}',{name})"
         if self.points is not None:
             return f"loop(start={self.start}, stop={self.stop}, points={self.points},{name})"
         return f"loop(start={self.start}, stop={self.stop}, incr={self.incr},{name})"
 
 
 
+class SweepND:
+    """
+    Cartesian product of loops, outermost loop first:
+
+        sweep = SweepND(flux_loop, power_loop, freq_loop, snake=True)
+        for flux, power, freq in sweep:
+            ...
+
+    Parameters
+    ----------
+    *loops : loop
+        Axes of the sweep, outermost first, innermost last.
+    snake : bool, default False
+        Serpentine order: every inner axis runs backwards on every
+        other pass of the axes outside it, so consecutive points
+        differ by one step of one axis (no fly-back of slow
+        instruments like GS820 ramps or LO retuning).
+    start : int, default 0
+        Flat index of the first point yielded, to resume an
+        interrupted run at point k.
+
+    sweep.cursor is the flat index of the point last yielded.
+    Points are numbered 0 .. len(sweep)-1 in the order they are
+    measured (with snake=True this is not the raster order, see
+    order()).
+    """
+
+    def __init__(self, *loops, snake: bool = False, start: int = 0):
+        if not loops:
+            raise ValueError("at least one loop is needed")
+        self.loops = loops
+        self.shape = tuple(len(l) for l in loops)
+        self.snake = bool(snake)
+        self.start = int(start)
+        self.cursor = None
+
+    def __len__(self):
+        return int(np.prod(self.shape))
+
+    def index(self, k: int) -> tuple:
+        """Per-axis indices (outermost first) of the k-th point."""
+        if not 0 <= k < len(self):
+            raise IndexError(f"point {k} is outside the sweep of {len(self)} points")
+        digits = np.unravel_index(k, self.shape)
+        if not self.snake:
+            return tuple(int(d) for d in digits)
+        out = []
+        outer = 0
+        for d, n in zip(digits, self.shape):
+            # axis runs backwards when the passes outside it are odd
+            out.append(int(n - 1 - d) if outer % 2 else int(d))
+            outer = outer * n + int(d)
+        return tuple(out)
+
+    def point(self, k: int) -> tuple:
+        """Values (outermost first) of the k-th point."""
+        return tuple(l[i] for l, i in zip(self.loops, self.index(k)))
+
+    def __getitem__(self, k: int) -> tuple:
+        return self.point(k)
+
+    def indices(self) -> Iterator[tuple]:
+        """Per-axis indices of all points from start on."""
+        for k in range(self.start, len(self)):
+            yield self.index(k)
+
+    def __iter__(self) -> Iterator[tuple]:
+        for k in range(self.start, len(self)):
+            self.cursor = k
+            yield self.point(k)
+
+    def order(self) -> np.ndarray:
+        """
+        Raster (C-order) flat index of every point in measurement
+        order, for reordering snake data onto the grid:
+            grid = np.empty(sweep.shape); grid.flat[sweep.order()] = values
+        """
+        k = np.arange(len(self))
+        if not self.snake:
+            return k
+        digits = np.unravel_index(k, self.shape)
+        out = []
+        outer = np.zeros(len(k), dtype=np.int64)
+        for d, n in zip(digits, self.shape):
+            out.append(np.where(outer % 2 == 1, n - 1 - d, d))
+            outer = outer * n + d
+        return np.ravel_multi_index(out, self.shape)
+
+    def meta(self) -> list:
+        """
+        Meta lists [n_points, first, last, name] of all axes,
+        innermost first (the order of meta_quick).
+        """
+        metas = []
+        for l in reversed(self.loops):
+            values = l.to_array()
+            name = l.name if l.name is not None else "Nothing"
+            metas.append([len(values), float(values[0]), float(values[-1]), str(name)])
+        return metas
+
+    def __repr__(self):
+        inner = ", ".join(repr(l) for l in self.loops)
+        return f"SweepND({inner}, snake={self.snake}, start={self.start})"
+
+
+class adaptive_loop:
+    """
+    Non-uniform sweep from start to stop that adds points only
+    where the measured signal changes, e.g. around a narrow
+    resonance or an avoided crossing.
+
+    The sweep starts with `points` uniform setpoints, then keeps
+    bisecting the interval with the largest score until every
+    score is below tol or `budget` points are measured. The score
+    of an interval is the larger of
+      - its length in the normalised (x, |y|) plane, x relative to
+        |stop-start| and |y| to the peak-to-peak of |y| measured
+        so far, and
+      - the curvature at its ends (distance of |y| at a point
+        from the straight line through its neighbours, relative
+        to the peak-to-peak of |y|).
+    The x part keeps wide intervals from being skipped: a narrow
+    peak between two starting points, with about the same |y| at
+    both ends, is still found. Flat parts end up with steps of
+    about tol*|stop-start|.
+
+    Parameters
+    ----------
+    start, stop : number
+    measure : callable
+        measure(x) -> value at setpoint x (real or complex, |value|
+        is used for the refinement, e.g. S21).
+    points : int, default 11
+        Number of uniform starting points.
+    budget : int, default 201
+        Maximum number of measured points.
+    tol : float, default 0.02
+        Stop refining when all scores are below tol.
+    min_step : float, optional
+        Intervals shorter than 2*min_step are not split.
+        Default |stop-start|*1e-6.
+    name : str, optional
+
+    After run(), the instance behaves like a loop over the sorted
+    (non-uniform) setpoints: len(), iteration, indexing and
+    to_array() work, and .values holds the measured values in the
+    same order. meta_quick records the setpoints in the .meta.txt
+    ('#values' line), which Data2D and DataND use as coordinates.
+    """
+
+    def __init__(self,
+                 start: float,
+                 stop: float,
+                 measure,
+                 points: int = 11,
+                 budget: int = 201,
+                 tol: float = 0.02,
+                 min_step: Optional[float] = None,
+                 name: Optional[str] = None):
+        if points < 2:
+            raise ValueError("points must be >= 2")
+        if budget < points:
+            raise ValueError("budget must be >= points")
+        self.start = float(start)
+        self.stop = float(stop)
+        self.measure = measure
+        self.points = int(points)
+        self.budget = int(budget)
+        self.tol = float(tol)
+        self.min_step = abs(self.stop - self.start) * 1e-6 if min_step is None else float(min_step)
+        self.name = name
+        self._x = np.zeros(0)
+        self.values = np.zeros(0)
+
+    def _scores(self, x, y) -> np.ndarray:
+        a = np.abs(y)
+        scale = np.ptp(a)
+        if scale == 0:
+            scale = 1.0
+        span = abs(x[-1] - x[0]) or 1.0
+        score = np.hypot(np.diff(x) / span, np.diff(a) / scale)
+        if len(x) > 2:
+            # deviation of each interior point from the line through its neighbours
+            w = (x[1:-1] - x[:-2]) / (x[2:] - x[:-2])
+            curv = np.abs(a[1:-1] - (a[:-2] + w * (a[2:] - a[:-2]))) / scale
+            score[:-1] = np.maximum(score[:-1], curv)
+            score[1:] = np.maximum(score[1:], curv)
+        score[np.diff(x) < 2 * self.min_step] = 0
+        return score
+
+    def run(self):
+        """Measure the sweep, returns (setpoints, values) sorted by setpoint."""
+        x = np.linspace(self.start, self.stop, self.points)
+        y = np.array([self.measure(v) for v in x])
+        if self.start > self.stop:
+            x, y = x[::-1], y[::-1]
+        while len(x) < self.budget:
+            score = self._scores(x, y)
+            i = int(np.argmax(score))
+            if score[i] < self.tol:
+                break
+            xm = 0.5 * (x[i] + x[i + 1])
+            x = np.insert(x, i + 1, xm)
+            y = np.insert(y, i + 1, self.measure(xm))
+        if self.start > self.stop:
+            x, y = x[::-1], y[::-1]
+        self._x = x
+        self.values = y
+        return x, y
+
+    def to_array(self) -> np.ndarray:
+        """Measured setpoints (in start -> stop order)."""
+        return self._x
+
+    def to_list(self):
+        return self._x.tolist()
+
+    def __iter__(self) -> Iterator[float]:
+        return iter(self._x.tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._x[index]
+        return float(self._x[index])
+
+    def __len__(self):
+        return len(self._x)
+
+    def __repr__(self):
+        name = f" name='{self.name}'" if self.name is not None else ""
+        return f"adaptive_loop(start={self.start}, stop={self.stop}, points={self.points}, budget={self.budget},{name})"
+
+
 
 # # EXAMPLES:
 # # usage_examples.py
@@ -157,6 +468,26 @@ class loop:
 #     print(v)
 # # 0.0, 0.3, 0.6, 0.8999999999999999 (close to 0.9; endpoint included by default)
 
+# # indexing and numpy export:
+# l2[1], l2[-1], l2[::2]      # 0.3, 0.8999999999999999, array([0. , 0.6])
+# l1.to_array()               # array([0.  , 0.25, 0.5 , 0.75, 1.  ])
+# list(l1.chunks(2))          # [array([0.  , 0.25]), array([0.5 , 0.75]), array([1.])]
+
+# # non-linear spacing:
+# loop(1e-6, 1e-3, points=4, spacing='log')     # 1e-6, 1e-5, 1e-4, 1e-3
+# loop(-40, 0, points=5, spacing='dB')          # equal steps in mW, returned in dBm
+# loop(4e9, 5e9, points=101, spacing='center', center=4.6e9)
+# loop.from_array([0, 0.1, 0.5, 2], name='time')
+
+# # nested sweep with snake order, resumed at point 7:
+# sw = SweepND(loop(0, 1, points=3, name='power'), loop(0, 2, points=3, name='freq'),
+#              snake=True, start=7)
+# list(sw)    # [(1.0, 1.0), (1.0, 2.0)]
+
+# # adaptive sweep around a resonance:
+# al = adaptive_loop(4.5e9, 4.6e9, lambda f: vna_point(f), points=21, budget=151, name='freq')
+# freqs, s21 = al.run()
+
 
 
 